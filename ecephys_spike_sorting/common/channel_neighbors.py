@@ -0,0 +1,122 @@
+import numpy as np
+
+from .spike_groups import SpikeGroups
+
+
+class ChannelNeighbors():
+
+    """
+    Spatial index of probe channels
+
+    Holds the distances between all channels, built once per probe, and
+    caches radius neighbour lists and distance orderings keyed by channel
+    (usually a unit's peak channel), so per-unit loops don't recompute
+    them. If pc_feature_ind is given, it also indexes which units have
+    PCs on each channel.
+
+    """
+
+    def __init__(self, channel_pos, pc_feature_ind = None):
+
+        """
+        channel_pos : numpy.ndarray (num_channels x 2)
+            X and Z coordinates for each channel (um)
+        pc_feature_ind : numpy.ndarray (num_units x num_pc_channels) (optional)
+            Channel indices of PCs for each unit
+        """
+
+        self.channel_pos = channel_pos
+
+        self.distances = np.sqrt(np.square(channel_pos[:, np.newaxis, 0] - channel_pos[np.newaxis, :, 0]) + \
+                                 np.square(channel_pos[:, np.newaxis, 1] - channel_pos[np.newaxis, :, 1]))
+
+        self._radius_lists = {}
+        self._distance_order = {}
+
+        if pc_feature_ind is not None:
+            self.pc_feature_ind_shape = pc_feature_ind.shape
+            self._pc_channels = SpikeGroups(pc_feature_ind.flatten().astype('int64'), channel_pos.shape[0])
+        else:
+            self._pc_channels = None
+
+
+    def distances_from(self, channel):
+
+        """ Returns the distance (um) from one channel to every channel """
+
+        return self.distances[channel, :]
+
+
+    def within_radius(self, channel, radius):
+
+        """ Returns the channels closer than radius (um) to one channel
+
+        Input:
+        ------
+        channel : int
+            Index into channel_pos
+        radius : float
+            Maximum distance in um (exclusive)
+
+        Output:
+        -------
+        channels : numpy.ndarray
+            Channel indices, in ascending order
+
+        """
+
+        key = (channel, radius)
+
+        if key not in self._radius_lists:
+            self._radius_lists[key] = np.where(self.distances[channel, :] < radius)[0]
+
+        return self._radius_lists[key]
+
+
+    def sorted_by_distance(self, channel):
+
+        """ Returns all channel indices ordered by distance from one channel """
+
+        if channel not in self._distance_order:
+            self._distance_order[channel] = np.argsort(self.distances[channel, :])
+
+        return self._distance_order[channel]
+
+
+    def neighbor_table(self, channels, radius):
+
+        """ Returns a boolean table of which channels are closer than radius
+
+        Input:
+        ------
+        channels : numpy.ndarray (num_units x 0)
+            Channel of each unit (e.g. peak channel index)
+        radius : float
+            Maximum distance in um (exclusive)
+
+        Output:
+        -------
+        neighbors : numpy.ndarray (num_units x num_units)
+            True where the two units' channels are closer than radius
+
+        """
+
+        return self.distances[np.ix_(channels, channels)] < radius
+
+
+    def units_with_pcs_on(self, channel):
+
+        """ Returns the units that have PCs on one channel
+
+        Same order as np.where(pc_feature_ind.flatten() == channel).
+
+        Output:
+        -------
+        units : numpy.ndarray
+            Unit (row of pc_feature_ind) for each match
+        channel_index : numpy.ndarray
+            Column of pc_feature_ind for each match
+
+        """
+
+        return np.unravel_index(self._pc_channels.indices(channel), self.pc_feature_ind_shape)
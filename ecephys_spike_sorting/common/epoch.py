@@ -46,6 +46,29 @@ class Epoch():
         else:
             self.end_index = timestamps.size
 
+    def spike_slice(self, spike_times):
+
+        """ Returns the range of spikes that fall within this epoch
+
+        Same spikes as (spike_times > start_time) * (spike_times < end_time),
+        but as a slice, so indexing with it returns a view
+
+        Input:
+        ------
+        spike_times : numpy.ndarray (float)
+            Spike times in seconds, in ascending order
+
+        Output:
+        -------
+        in_epoch : slice
+
+        """
+
+        first = np.searchsorted(spike_times, self.start_time, side = 'right')
+        last = np.searchsorted(spike_times, self.end_time, side = 'left')
+
+        return slice(first, max(first, last))
+
 
 
 def get_epochs_from_nwb_file(filename):
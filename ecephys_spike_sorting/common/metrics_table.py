@@ -0,0 +1,186 @@
+import os
+
+import pandas as pd
+
+
+METRICS_KEY = ['cluster_id', 'epoch_name']
+
+COLUMNAR_FORMATS = {'.parquet' : 'parquet', '.feather' : 'feather'}
+
+
+def get_metrics_format(filename):
+
+    """ Returns 'csv', 'parquet' or 'feather', based on the file extension """
+
+    return COLUMNAR_FORMATS.get(os.path.splitext(filename)[1].lower(), 'csv')
+
+
+def require_pyarrow(metrics_format):
+
+    """ Raises ImportError if pyarrow, needed for Parquet and Feather files, is not installed """
+
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('Metrics files in ' + metrics_format + ' format require pyarrow; '
+                          'install it with pip install ecephys_spike_sorting[columnar], '
+                          'or use a .csv file') from None
+
+
+def read_metrics(filename):
+
+    """ Reads a cluster or waveform metrics table
+
+    CSV files are read as written by DataFrame.to_csv (with the index in
+    the first column); Parquet and Feather files are read with their stored
+    column types. Parquet and Feather require pyarrow.
+
+    Input:
+    ------
+    filename : str
+        Path to .csv, .parquet or .feather file
+
+    Output:
+    -------
+    metrics : pandas.DataFrame
+
+    """
+
+    metrics_format = get_metrics_format(filename)
+
+    if metrics_format != 'csv':
+        require_pyarrow(metrics_format)
+
+    if metrics_format == 'parquet':
+        return pd.read_parquet(filename)
+    elif metrics_format == 'feather':
+        return pd.read_feather(filename)
+    else:
+        return pd.read_csv(filename, index_col=0)
+
+
+def write_metrics(metrics, filename, append = False):
+
+    """ Writes a cluster or waveform metrics table
+
+    The format follows the file extension. CSV output is unchanged from
+    DataFrame.to_csv. For Parquet and Feather (which require pyarrow), the
+    table is keyed by (cluster_id, epoch_name): the key columns come first,
+    with fixed types (int64 and string), and rows are sorted by key.
+
+    With append = True, the rows already in the file are kept, except those
+    with the same (cluster_id, epoch_name) as a new row, which are replaced.
+    This way metrics for one epoch or one set of units can be added to an
+    existing table without rewriting it from scratch.
+
+    Inputs:
+    -------
+    metrics : pandas.DataFrame
+        One row per unit per epoch
+    filename : str
+        Path to .csv, .parquet or .feather file
+    append : bool
+        If True, add to (or replace rows in) an existing file
+
+    """
+
+    metrics_format = get_metrics_format(filename)
+
+    if metrics_format != 'csv':
+        require_pyarrow(metrics_format)
+
+    if append and os.path.exists(filename):
+        metrics = upsert_metrics(read_metrics(filename), metrics)
+
+    if metrics_format == 'csv':
+        metrics.to_csv(filename)
+        return
+
+    metrics = as_keyed_table(metrics).sort_values(METRICS_KEY, kind='stable', ignore_index=True)
+
+    if metrics_format == 'parquet':
+        metrics.to_parquet(filename, index=False)
+    else:
+        metrics.to_feather(filename)
+
+
+def upsert_metrics(existing, metrics):
+
+    """ Adds rows to a metrics table, replacing those with the same (cluster_id, epoch_name)
+
+    Inputs:
+    -------
+    existing : pandas.DataFrame
+        Metrics table to add to
+    metrics : pandas.DataFrame
+        New rows
+
+    Output:
+    -------
+    metrics : pandas.DataFrame
+        Rows of existing that are not in metrics, followed by metrics
+
+    """
+
+    replaced = get_metrics_key(existing).isin(get_metrics_key(metrics))
+
+    return pd.concat((existing[~replaced], metrics), ignore_index=True)
+
+
+def get_metrics_key(metrics):
+
+    """ Returns the (cluster_id, epoch_name) of each row as a typed MultiIndex """
+
+    return pd.MultiIndex.from_arrays([metrics['cluster_id'].to_numpy().astype('int64'),
+                                      metrics['epoch_name'].to_numpy().astype('str')],
+                                     names=METRICS_KEY)
+
+
+def merge_metrics(cluster_metrics, waveform_metrics, columnar = False):
+
+    """ Adds waveform metrics to a cluster metrics table
+
+    Inputs:
+    -------
+    cluster_metrics : pandas.DataFrame
+        Output of quality_metrics
+    waveform_metrics : pandas.DataFrame
+        Output of mean_waveforms
+    columnar : bool
+        If False, merge on cluster_id only, as for the CSV files (columns in
+        both tables get the suffixes _quality_metrics and _waveform_metrics).
+        If True, merge on (cluster_id, epoch_name), keeping units without
+        waveform metrics, and replace any waveform metrics columns already
+        in cluster_metrics.
+
+    Output:
+    -------
+    metrics : pandas.DataFrame
+
+    """
+
+    if not columnar:
+        return cluster_metrics.merge(waveform_metrics,
+                     on='cluster_id',
+                     suffixes=('_quality_metrics','_waveform_metrics'))
+
+    waveform_metrics = as_keyed_table(waveform_metrics)
+    cluster_metrics = as_keyed_table(cluster_metrics)
+
+    replaced = [column for column in waveform_metrics.columns
+                if column in cluster_metrics.columns and column not in METRICS_KEY]
+
+    return cluster_metrics.drop(columns=replaced).merge(waveform_metrics, on=METRICS_KEY, how='left')
+
+
+def as_keyed_table(metrics):
+
+    """ Returns a copy of a metrics table with typed key columns first and no index """
+
+    metrics = metrics.reset_index(drop=True)
+
+    metrics = metrics.astype({'cluster_id' : 'int64', 'epoch_name' : 'str'})
+
+    columns = METRICS_KEY + [column for column in metrics.columns if column not in METRICS_KEY]
+
+    return metrics[columns]
@@ -29,7 +29,7 @@ class CommonFiles(DefaultSchema):
     settings_json = String(help='Location of settings JSON written by extract_from_npx module')
 
 class WaveformMetricsFile(DefaultSchema):
-    waveform_metrics_file = String(help='Location of waveform metrics CSV')
+    waveform_metrics_file = String(help='Location of waveform metrics file (.csv, or .parquet / .feather for a typed table keyed by cluster_id and epoch_name)')
     
 class ClusterMetricsFile(DefaultSchema):
-    cluster_metrics_file = String(help='Location of cluster metrics CSV')
+    cluster_metrics_file = String(help='Location of cluster metrics file (.csv, or .parquet / .feather for a typed table keyed by cluster_id and epoch_name)')
@@ -0,0 +1,154 @@
+import numpy as np
+
+
+class SpikeGroups():
+
+    """
+    Groups spike indices by cluster ID
+
+    A single stable argsort of spike_clusters places the spikes of each
+    cluster in one contiguous block (in their original order), so the
+    spikes for any unit can be retrieved as a slice instead of a boolean
+    mask over the full spike array.
+
+    """
+
+    def __init__(self, spike_clusters, total_units = None):
+
+        """
+        spike_clusters : numpy.ndarray (num_spikes x 0)
+            Cluster IDs for each spike
+        total_units : int (optional)
+            Minimum number of cluster IDs to allocate offsets for
+        """
+
+        spike_clusters = np.squeeze(spike_clusters)
+
+        if total_units is None:
+            total_units = 0
+
+        self.order = np.argsort(spike_clusters, kind = 'stable')
+        self.counts = np.bincount(spike_clusters, minlength = total_units)
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)))
+        self.cluster_ids = np.where(self.counts > 0)[0]
+        self.total_spikes = spike_clusters.size
+
+
+    def indices(self, cluster_id):
+
+        """ Returns the indices of all spikes for one cluster (in original order)
+
+        Input:
+        ------
+        cluster_id : int
+            ID for this cluster
+
+        Output:
+        -------
+        inds : numpy.ndarray
+            Spike indices for this cluster
+
+        """
+
+        if cluster_id >= self.counts.size:
+            return self.order[:0]
+
+        return self.order[self.offsets[cluster_id]:self.offsets[cluster_id+1]]
+
+
+    def count(self, cluster_id):
+
+        """ Returns the number of spikes for one cluster """
+
+        if cluster_id >= self.counts.size:
+            return 0
+
+        return self.counts[cluster_id]
+
+
+    def counts_for(self, cluster_ids):
+
+        """ Returns the number of spikes for each of an array of clusters """
+
+        cluster_ids = np.asarray(cluster_ids)
+        counts = np.zeros(cluster_ids.shape, dtype = self.counts.dtype)
+
+        in_range = cluster_ids < self.counts.size
+        counts[in_range] = self.counts[cluster_ids[in_range]]
+
+        return counts
+
+
+    def sort(self, values):
+
+        """ Reorders a per-spike array so that each cluster occupies a contiguous block
+
+        Input:
+        ------
+        values : numpy.ndarray (num_spikes x ...)
+            Any array with one entry per spike
+
+        Output:
+        -------
+        sorted_values : numpy.ndarray (num_spikes x ...)
+            Values grouped by cluster; use segment() to index a single cluster
+
+        """
+
+        return values[self.order]
+
+
+    def segment(self, sorted_values, cluster_id):
+
+        """ Returns the block of a cluster-sorted array belonging to one cluster
+
+        Input:
+        ------
+        sorted_values : numpy.ndarray
+            Output of sort()
+        cluster_id : int
+            ID for this cluster
+
+        Output:
+        -------
+        values : numpy.ndarray
+            View of sorted_values for this cluster
+
+        """
+
+        if cluster_id >= self.counts.size:
+            return sorted_values[:0]
+
+        return sorted_values[self.offsets[cluster_id]:self.offsets[cluster_id+1]]
+
+
+    def subsample(self, cluster_id, max_num, random_state = None):
+
+        """ Returns a random subset of spike indices for one cluster, in ascending order
+
+        Draws from np.random in the same way as make_index_mask in the quality
+        metrics module, so both give the same subsample for a given seed.
+
+        Inputs:
+        -------
+        cluster_id : int
+            ID for this cluster
+        max_num : int
+            Maximum number of spikes to return
+        random_state : numpy.random.RandomState (optional)
+            Generator to draw from instead of the global np.random state
+
+        Output:
+        -------
+        inds : numpy.ndarray
+            Sorted spike indices for this cluster
+
+        """
+
+        if random_state is None:
+            random_state = np.random
+
+        inds = self.indices(cluster_id)
+        order = random_state.permutation(inds.size)
+
+        return np.sort(inds[order[:max_num]])
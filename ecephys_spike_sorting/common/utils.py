@@ -220,7 +220,7 @@ def read_cluster_amplitude_tsv(filename):
 
     return cluster_amplitude
 
-def load(folder, filename):
+def load(folder, filename, mmap_mode = None):
 
     """
     Loads a numpy file from a folder.
@@ -231,6 +231,8 @@ def load(folder, filename):
         Directory containing the file to load
     filename : String
         Name of the numpy file
+    mmap_mode : String or None (optional)
+        If not None, memory-map the file with this mode (see numpy.load)
 
     Outputs:
     --------
@@ -239,7 +241,7 @@ def load(folder, filename):
 
     """
 
-    return np.load(os.path.join(folder, filename))
+    return np.load(os.path.join(folder, filename), mmap_mode = mmap_mode)
 
 
 def load_kilosort_data(folder, 
@@ -247,7 +249,8 @@ def load_kilosort_data(folder,
                        convert_to_seconds = True, 
                        use_master_clock = False, 
                        include_pcs = False,
-                       template_zero_padding= 21):
+                       template_zero_padding= 21,
+                       mmap_mode = None):
 
     """
     Loads Kilosort output files from a directory
@@ -266,6 +269,8 @@ def load_kilosort_data(folder,
         Flags whether to load spike principal components (large file)
     template_zero_padding : int (default = 21)
         Number of zeros added to the beginning of each template
+    mmap_mode : String or None (default = None)
+        Memory-map mode for pc_features and template_features (see KilosortData)
 
     Outputs:
     --------
@@ -298,56 +303,237 @@ def load_kilosort_data(folder,
 
     """
 
-    if use_master_clock:
-        spike_times = load(folder,'spike_times_master_clock.npy')
-    else:
-        spike_times = load(folder,'spike_times.npy')
-        
-    spike_clusters = load(folder,'spike_clusters.npy')
-    spike_templates = load(folder, 'spike_templates.npy')
-    amplitudes = load(folder,'amplitudes.npy')
-    templates = load(folder,'templates.npy')
-    unwhitening_mat = load(folder,'whitening_mat_inv.npy')
-    channel_map = load(folder, 'channel_map.npy')
-    channel_pos = load(folder, 'channel_positions.npy')
-
-    if include_pcs:
-        pc_features = load(folder, 'pc_features.npy')
-        pc_feature_ind = load(folder, 'pc_feature_ind.npy')
-        template_features = load(folder, 'template_features.npy') 
-
-                
-    templates = templates[:,template_zero_padding:,:] # remove zeros
-    spike_clusters = np.squeeze(spike_clusters) # fix dimensions
-    spike_times = np.squeeze(spike_times)# fix dimensions
-
-    if convert_to_seconds and sample_rate is not None:
-       spike_times = spike_times / sample_rate 
-                    
-    unwhitened_temps = np.zeros((templates.shape))
-    
-    for temp_idx in range(templates.shape[0]):
-        
-        unwhitened_temps[temp_idx,:,:] = np.dot(np.ascontiguousarray(templates[temp_idx,:,:]),np.ascontiguousarray(unwhitening_mat))
-                    
-    try:
-        cluster_ids, cluster_quality = read_cluster_group_tsv(os.path.join(folder, 'cluster_group.tsv'))
-    except OSError:
-        cluster_ids = np.unique(spike_clusters)
-        cluster_quality = ['unsorted'] * cluster_ids.size
-        
-    cluster_amplitude = read_cluster_amplitude_tsv(os.path.join(folder, 'cluster_Amplitude.tsv'))
-    
-        
-        
+    data = KilosortData(folder,
+                        sample_rate,
+                        convert_to_seconds = convert_to_seconds,
+                        use_master_clock = use_master_clock,
+                        template_zero_padding = template_zero_padding,
+                        mmap_mode = mmap_mode)
 
     if not include_pcs:
-        return spike_times, spike_clusters, spike_templates, amplitudes, unwhitened_temps, \
-               channel_map, channel_pos, cluster_ids, cluster_quality, cluster_amplitude
+        return data.spike_times, data.spike_clusters, data.spike_templates, data.amplitudes, data.templates, \
+               data.channel_map, data.channel_pos, data.cluster_ids, data.cluster_quality, data.cluster_amplitude
     else:
-        return spike_times, spike_clusters, spike_templates, amplitudes, unwhitened_temps, \
-               channel_map, channel_pos, cluster_ids, cluster_quality, cluster_amplitude, \
-               pc_features, pc_feature_ind, template_features
+        return data.spike_times, data.spike_clusters, data.spike_templates, data.amplitudes, data.templates, \
+               data.channel_map, data.channel_pos, data.cluster_ids, data.cluster_quality, data.cluster_amplitude, \
+               data.pc_features, data.pc_feature_ind, data.template_features
+
+
+class KilosortData():
+
+    """
+    Lazily loads Kilosort output files from a directory
+
+    Each file is read the first time its attribute is accessed and then cached,
+    so callers only pay for the fields they use. The large per-spike feature 
+    files (pc_features and template_features) are opened as read-only memory 
+    maps by default, so they are paged in from disk as they are indexed rather
+    than read into memory up front.
+
+    Attributes match the outputs of load_kilosort_data:
+
+        spike_times, spike_clusters, spike_templates, amplitudes, templates 
+        (unwhitened), channel_map, channel_pos, cluster_ids, cluster_quality, 
+        cluster_amplitude, pc_features, pc_feature_ind, template_features
+
+    """
+
+    def __init__(self, 
+                 folder, 
+                 sample_rate = None, 
+                 convert_to_seconds = True, 
+                 use_master_clock = False, 
+                 template_zero_padding = 21,
+                 mmap_mode = 'r'):
+
+        """
+        folder : String
+            Location of Kilosort output directory
+        sample_rate : float (optional)
+            AP band sample rate in Hz
+        convert_to_seconds : bool (optional)
+            Flags whether to return spike times in seconds (requires sample_rate to be set)
+        use_master_clock : bool (optional)
+            Flags whether to load spike times that have been converted to the master clock timebase
+        template_zero_padding : int (default = 21)
+            Number of zeros added to the beginning of each template
+        mmap_mode : String or None (default = 'r')
+            Memory-map mode for pc_features and template_features; None reads them into memory
+        """
+
+        self.folder = folder
+        self.sample_rate = sample_rate
+        self.convert_to_seconds = convert_to_seconds
+        self.use_master_clock = use_master_clock
+        self.template_zero_padding = template_zero_padding
+        self.mmap_mode = mmap_mode
+
+        self._cache = {}
+
+
+    def _get(self, name, loader):
+
+        if name not in self._cache:
+            self._cache[name] = loader()
+
+        return self._cache[name]
+
+
+    def clear(self):
+
+        """ Drops all cached arrays (and closes any memory maps that are no longer referenced) """
+
+        self._cache = {}
+
+
+    @property
+    def spike_times(self):
+
+        def loader():
+            if self.use_master_clock:
+                spike_times = load(self.folder, 'spike_times_master_clock.npy')
+            else:
+                spike_times = load(self.folder, 'spike_times.npy')
+
+            spike_times = np.squeeze(spike_times) # fix dimensions
+
+            if self.convert_to_seconds and self.sample_rate is not None:
+                spike_times = spike_times / self.sample_rate
+
+            return spike_times
+
+        return self._get('spike_times', loader)
+
+    @property
+    def spike_clusters(self):
+        return self._get('spike_clusters', lambda: np.squeeze(load(self.folder, 'spike_clusters.npy')))
+
+    @property
+    def spike_templates(self):
+        return self._get('spike_templates', lambda: load(self.folder, 'spike_templates.npy'))
+
+    @property
+    def amplitudes(self):
+        return self._get('amplitudes', lambda: load(self.folder, 'amplitudes.npy'))
+
+    @property
+    def templates(self):
+
+        # remove zeros
+        return self._unwhitened()[0][:,self.template_zero_padding:,:]
+
+    @property
+    def peak_channel_idx(self):
+        """ Index (into channel_map) of the peak channel of each template """
+        return self._unwhitened()[1]
+
+    @property
+    def template_amplitudes(self):
+        """ Peak-to-trough amplitude of each unwhitened template on its peak channel """
+        return self._unwhitened()[2]
+
+    def _unwhitened(self):
+        return self._get('unwhitened', lambda: get_unwhitened_templates(self.folder))
+
+    @property
+    def channel_map(self):
+        return self._get('channel_map', lambda: load(self.folder, 'channel_map.npy'))
+
+    @property
+    def channel_pos(self):
+        return self._get('channel_pos', lambda: load(self.folder, 'channel_positions.npy'))
+
+    @property
+    def cluster_ids(self):
+        self._load_cluster_groups()
+        return self._cache['cluster_ids']
+
+    @property
+    def cluster_quality(self):
+        self._load_cluster_groups()
+        return self._cache['cluster_quality']
+
+    def _load_cluster_groups(self):
+
+        if 'cluster_ids' not in self._cache:
+            try:
+                cluster_ids, cluster_quality = read_cluster_group_tsv(os.path.join(self.folder, 'cluster_group.tsv'))
+            except OSError:
+                cluster_ids = np.unique(self.spike_clusters)
+                cluster_quality = ['unsorted'] * cluster_ids.size
+
+            self._cache['cluster_ids'] = cluster_ids
+            self._cache['cluster_quality'] = cluster_quality
+
+    @property
+    def cluster_amplitude(self):
+        return self._get('cluster_amplitude', lambda: read_cluster_amplitude_tsv(os.path.join(self.folder, 'cluster_Amplitude.tsv')))
+
+    @property
+    def pc_features(self):
+        return self._get('pc_features', lambda: load(self.folder, 'pc_features.npy', self.mmap_mode))
+
+    @property
+    def pc_feature_ind(self):
+        return self._get('pc_feature_ind', lambda: load(self.folder, 'pc_feature_ind.npy'))
+
+    @property
+    def template_features(self):
+        return self._get('template_features', lambda: load(self.folder, 'template_features.npy', self.mmap_mode))
+
+
+def get_unwhitened_templates(folder, use_cache = True):
+
+    """
+    Unwhitens all Kilosort templates and finds the peak channel of each
+
+    All templates are multiplied by the inverse whitening matrix in a single
+    batched product. The result is cached in the Kilosort output directory
+    (templates_unwhitened.npy) and reused as long as it is newer than 
+    templates.npy and whitening_mat_inv.npy.
+
+    Inputs:
+    -------
+    folder : String
+        Location of Kilosort output directory
+    use_cache : bool (optional)
+        Flags whether to read and write the cached file
+
+    Outputs:
+    --------
+    unwhitened_temps : numpy.ndarray (M x samples x channels)
+        Unwhitened templates for M units (including zero padding)
+    peak_channel_idx : numpy.ndarray (M x 0)
+        Index (into channel_map) of the channel with the largest peak-to-trough amplitude
+    template_amplitudes : numpy.ndarray (M x 0)
+        Peak-to-trough amplitude of each template on its peak channel
+
+    """
+
+    cache_file = os.path.join(folder, 'templates_unwhitened.npy')
+    sources = [os.path.join(folder, 'templates.npy'), os.path.join(folder, 'whitening_mat_inv.npy')]
+
+    if use_cache and os.path.exists(cache_file) and \
+       os.path.getmtime(cache_file) >= np.max([os.path.getmtime(f) for f in sources]):
+        unwhitened_temps = np.load(cache_file)
+    else:
+        templates = load(folder, 'templates.npy')
+        unwhitening_mat = load(folder, 'whitening_mat_inv.npy')
+
+        # (W_inv @ template.T).T for all templates at once
+        unwhitened_temps = np.matmul(templates, unwhitening_mat.T)
+
+        if use_cache:
+            try:
+                np.save(cache_file, unwhitened_temps)
+            except OSError:
+                print('Could not cache unwhitened templates in ' + folder)
+
+    template_ranges = np.max(unwhitened_temps,1) - np.min(unwhitened_temps,1)
+    peak_channel_idx = np.argmax(template_ranges,1)
+    template_amplitudes = np.max(template_ranges,1)
+
+    return unwhitened_temps, peak_channel_idx, template_amplitudes
 
 
 def get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos):
@@ -375,8 +561,8 @@ def get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos):
 
     """
 
-    pc_features_copy = np.copy(pc_features)
-    pc_features_copy = np.squeeze(pc_features_copy[:,0,:])
+    # copy only the first PC, rather than the full array
+    pc_features_copy = np.squeeze(np.array(pc_features[:,0,:]))
     pc_features_copy[pc_features_copy < 0] = 0
     pc_power = pow(pc_features_copy, 2)
     
@@ -420,7 +606,7 @@ def get_spike_amplitudes(spike_templates, templates, amplitudes):
 
 
 
-def get_repo_commit_date_and_hash(repo_location):
+def get_repo_commit_date_and_hash(repo_location, search_parent_directories=False):
 
     """
     Finds the date and hash of the latest commit in a git repository
@@ -429,6 +615,8 @@ def get_repo_commit_date_and_hash(repo_location):
     ------
     repo_location - String
         Local directory containing the git repository
+    search_parent_directories - bool
+        If True, repo_location can be any directory inside the repository
 
     Outputs:
     --------
@@ -441,7 +629,7 @@ def get_repo_commit_date_and_hash(repo_location):
 
     if os.path.exists(repo_location):
         try:
-            repo = Repo(repo_location)
+            repo = Repo(repo_location, search_parent_directories=search_parent_directories)
             headcommit = repo.head.commit
             commit_date = time.strftime("%a, %d %b %Y %H:%M", time.gmtime(headcommit.committed_date))
             commit_hash = headcommit.hexsha
@@ -549,25 +737,16 @@ def getSortResults(output_dir):
     unqLabel, labelCounts = np.unique(cluLabel, return_counts = True)
     nTot = cluLabel.shape[0]
 
-    templates = np.load(os.path.join(output_dir, 'templates.npy'))
     channel_map = np.load(os.path.join(output_dir, 'channel_map.npy'))
     channel_map = np.squeeze(channel_map)
     
-    # read in inverse of whitening matrix
-    w_inv = np.load((os.path.join(output_dir, 'whitening_mat_inv.npy')))
-    nTemplate = templates.shape[0]
-    
-    # initialize peak_channels array
-    peak_channels = np.zeros([nTemplate,],'uint32')
-    
-    # for each template (nt x nchan), multiply the the transpose (nchan x nt) by inverse of 
-    # the whitening matrix (nchan x nchan); get max and min along tthe time axis (1)
-    # to find the peak channel
-    for i in np.arange(0,nTemplate):
-        currT = templates[i,:].T
-        curr_unwh = np.matmul(w_inv, currT)
-        currdiff = np.max(curr_unwh,1) - np.min(curr_unwh,1)
-        peak_channels[i] = channel_map[np.argmax(currdiff)]
+    # unwhiten all templates (nt x nchan) by the inverse of the whitening
+    # matrix (nchan x nchan); the peak channel has the largest max - min
+    # along the time axis
+    unwhitened_temps, peak_channel_idx, template_amplitudes = get_unwhitened_templates(output_dir)
+    nTemplate = unwhitened_temps.shape[0]
+
+    peak_channels = channel_map[peak_channel_idx].astype('uint32')
 
     clus_Table = np.zeros((nTemplate, 2), dtype='uint32')
     clus_Table[unqLabel, 0] = labelCounts
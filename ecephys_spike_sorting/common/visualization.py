@@ -5,7 +5,7 @@ from scipy.signal import butter, filtfilt, medfilt
 
 from .utils import (get_spike_depths, 
                     get_spike_amplitudes,
-                    load_kilosort_data,
+                    KilosortData,
                     rms)
 
 
@@ -39,13 +39,18 @@ def plotKsTemplates(ks_directory, raw_data_file, sample_rate = 30000, bit_volts
 
     """
 
-    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-    channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features= \
-                load_kilosort_data(ks_directory, 
+    data = KilosortData(ks_directory, 
                     sample_rate, 
                     convert_to_seconds = False,
-                    use_master_clock = False,
-                    include_pcs = True)
+                    use_master_clock = False)
+
+    spike_times = data.spike_times
+    spike_templates = data.spike_templates
+    amplitudes = data.amplitudes
+    templates = data.templates
+    channel_map = data.channel_map
+    clusterIDs = data.cluster_ids
+    cluster_quality = data.cluster_quality
 
     raw_data = np.memmap(raw_data_file, dtype='int16')
     data = np.reshape(raw_data, (int(raw_data.size / 384), 384))
@@ -141,15 +146,17 @@ def plotDriftmap(ks_directory, sample_rate = 30000, time_range = [0, np.inf], ex
 
     """
 
-    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-    channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                load_kilosort_data(ks_directory, 
+    data = KilosortData(ks_directory, 
                     sample_rate, 
-                    use_master_clock = False,
-                    include_pcs = True)
+                    use_master_clock = False)
+
+    spike_times = data.spike_times
+    spike_clusters = data.spike_clusters
+    clusterIDs = data.cluster_ids
+    cluster_quality = data.cluster_quality
 
-    spike_depths = get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos)
-    spike_amplitudes = get_spike_amplitudes(spike_templates, templates, amplitudes)
+    spike_depths = get_spike_depths(spike_clusters, data.pc_features, data.pc_feature_ind, data.channel_pos)
+    spike_amplitudes = get_spike_amplitudes(data.spike_templates, data.templates, data.amplitudes)
 
     if exclude_noise:
         good_units = clusterIDs[cluster_quality != 'noise']
@@ -353,13 +360,16 @@ def plotFullProbeTSNE(ks_directory, total_spikes=150000, exclude_noise = True, f
 
     from matplotlib.cm import get_cmap
 
-    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, channel_pos, \
-    clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                load_kilosort_data(ks_directory, 
+    data = KilosortData(ks_directory, 
                     30000., 
                     convert_to_seconds = False,
-                    use_master_clock = False,
-                    include_pcs = True)
+                    use_master_clock = False)
+
+    spike_clusters = data.spike_clusters
+    clusterIDs = data.cluster_ids
+    cluster_quality = data.cluster_quality
+    pc_features = data.pc_features
+    pc_feature_ind = data.pc_feature_ind
 
     if exclude_noise:
         good_units = clusterIDs[cluster_quality != 'noise']
@@ -17,9 +17,11 @@ class DepthEstimationParams(DefaultSchema):
     max_freq = Int(required=True, default=150, help='Maximum frequency to plot')
     channel_range = NumpyArray(required=True, default=[370,380], help='Channels assumed to be out of brain, but in saline')
     n_passes = Int(required=True, default=10, help='Number of times to compute offset and surface channel')
+    lfp_n_passes = Int(required=False, help='Number of one-second LFP windows used to find the surface channel (defaults to n_passes)')
     skip_s_per_pass = Int(required=True, default=5, help='Number of seconds between data chunks used on each pass') #default=100
     start_time = Float(required=True, default=0, help='First time (in seconds) for computing median offset')
     time_interval = Float(required=True, default=5, help='Number of seconds for computing median offset')
+    n_threads = Int(required=False, default=1, help='Number of passes (AP band offsets or LFP surface estimates) computed in parallel')
 
     nfft = Int(required=True, default=4096, help='Length of FFT used for calculations')
 
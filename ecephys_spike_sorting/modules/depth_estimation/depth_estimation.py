@@ -2,13 +2,15 @@ import glob
 import json
 import os
 
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 import matplotlib.pyplot as plt
 
 from scipy.signal import welch
 from scipy.ndimage.filters import gaussian_filter1d
 
-from ...common.utils import find_range, rms, printProgressBar
+from ...common.utils import find_range, printProgressBar
 from ...common.OEFileInfo import get_lfp_channel_order
 
 def compute_channel_offsets(ap_data, ephys_params, params):
@@ -42,20 +44,46 @@ def compute_channel_offsets(ap_data, ephys_params, params):
     offsets = np.zeros((numChannels, numIterations), dtype = 'int16')
     rms_noise = np.zeros((numChannels, numIterations), dtype='float')
 
-    for i in range(numIterations):
+    channels_per_block = 32
+    samples_per_read = 1024
+
+    def compute_pass(i):
 
         start_sample = int((params['start_time'] + params['skip_s_per_pass'] * i)* ephys_params['sample_rate'])
         end_sample = start_sample + int(params['time_interval'] * ephys_params['sample_rate'])
 
-        for ch in range(numChannels):
+        # contiguous reads of whole samples, transposed so that each channel's
+        # samples are contiguous (much faster than column slices of the memmap)
+        data = ap_data[start_sample:end_sample, :numChannels]
+        channel_data = np.empty((data.shape[1], data.shape[0]), dtype = data.dtype)
 
-            printProgressBar(i * numChannels + ch +1, numChannels * numIterations)
+        for first_sample in range(0, data.shape[0], samples_per_read):
+            channel_data[:, first_sample:first_sample + samples_per_read] = \
+                data[first_sample:first_sample + samples_per_read, :].T
+
+        offsets[:,i] = np.median(channel_data, 1)
+
+        for first_channel in range(0, numChannels, channels_per_block):
+
+            channels = slice(first_channel, first_channel + channels_per_block)
+
+            # squares of int16 values, summed in float64, are exact
+            median_subtr = channel_data[channels, :] - offsets[channels,i][:,np.newaxis]
+            sum_squares = np.sum(np.square(median_subtr.astype('float64')), 1)
+
+            rms_noise[channels,i] = np.sqrt(sum_squares / channel_data.shape[1]) * ephys_params['bit_volts']
+
+    num_threads = int(np.max([1, np.min([params.get('n_threads', 1), numIterations])]))
+
+    if num_threads > 1:
+        with ThreadPool(num_threads) as pool:
+            for i, _ in enumerate(pool.imap_unordered(compute_pass, range(numIterations))):
+                printProgressBar(i + 1, numIterations)
+    else:
+        for i in range(numIterations):
+            compute_pass(i)
+            printProgressBar(i + 1, numIterations)
 
-            data = ap_data[start_sample:end_sample, ch]
-            offsets[ch,i] = np.median(data)
-            median_subtr = data - offsets[ch,i]
-            rms_noise[ch,i] = rms(median_subtr) * ephys_params['bit_volts']
-        
     mask = np.ones((numChannels,), dtype=bool)
     mask[ephys_params['reference_channels']] = False
     mask[np.median(rms_noise,1) > params['hi_noise_thresh']] = False
@@ -103,45 +131,36 @@ def find_surface_channel(lfp_data, ephys_params, params):
     freq_range = params['freq_range']
     channel_range = params['channel_range']
     nfft = params['nfft']
-    n_passes = params['n_passes']
+    n_passes = params.get('lfp_n_passes', params['n_passes'])
 
     save_figure = params['save_figure']
 
+    if ephys_params['reorder_lfp_channels']:
+        channels = get_lfp_channel_order()
+    else:
+        channels = np.arange(nchannels).astype('int')
+
     candidates = np.zeros((n_passes,))
-    
-    for p in range(n_passes):
-        
+    last_pass = {}
+
+    def compute_pass(p):
+
         startPt = int(sample_frequency*params['skip_s_per_pass']*p)
         endPt = startPt + int(sample_frequency)
-    
-        if ephys_params['reorder_lfp_channels']:
-            channels = get_lfp_channel_order()
-        else:
-            channels = np.arange(nchannels).astype('int')
 
-        chunk = np.copy(lfp_data[startPt:endPt,channels])
-        
-        for ch in np.arange(nchannels):
-            chunk[:,ch] = chunk[:,ch] - np.median(chunk[:,ch])
-            
-        for ch in np.arange(nchannels):
-            chunk[:,ch] = chunk[:,ch] - np.median(chunk[:,channel_range[0]:channel_range[1]],1)
-        
-        power = np.zeros((int(nfft/2+1), nchannels))
-    
-        for ch in np.arange(nchannels):
+        chunk = subtract_lfp_medians(lfp_data[startPt:endPt,channels], channel_range)
 
-            printProgressBar(p * nchannels + ch + 1, nchannels * n_passes)
+        # all channels at once, along the time axis of a channel-major copy
+        sample_frequencies, power = welch(np.ascontiguousarray(chunk.T).astype('float32'),
+                                          fs=sample_frequency, nfft=nfft, axis=1)
+        power = power.T
 
-            sample_frequencies, Pxx_den = welch(chunk[:,ch], fs=sample_frequency, nfft=nfft)
-            power[:,ch] = Pxx_den
-        
         in_range = find_range(sample_frequencies, 0, params['max_freq'])
-        
+
         mask_chans = ephys_params['reference_channels']
 
         in_range_gamma = find_range(sample_frequencies, freq_range[0],freq_range[1])
-        
+
         values = np.log10(np.mean(power[in_range_gamma,:],0))
         values[mask_chans] = values[mask_chans-1]
         values = gaussian_filter1d(values,smoothing_amount)
@@ -152,7 +171,21 @@ def find_surface_channel(lfp_data, ephys_params, params):
             candidates[p] = np.max(surface_channels)
         else:
             candidates[p] = nchannels
-      
+
+        if p == n_passes - 1:
+            last_pass.update({'chunk' : chunk, 'power' : power, 'in_range' : in_range, 'values' : values})
+
+    num_threads = int(np.max([1, np.min([params.get('n_threads', 1), n_passes])]))
+
+    if num_threads > 1:
+        with ThreadPool(num_threads) as pool:
+            for p, _ in enumerate(pool.imap_unordered(compute_pass, range(n_passes))):
+                printProgressBar(p + 1, n_passes)
+    else:
+        for p in range(n_passes):
+            compute_pass(p)
+            printProgressBar(p + 1, n_passes)
+
     surface_channel = np.median(candidates)
     air_channel = np.min([surface_channel + params['air_gap'], nchannels])
 
@@ -162,10 +195,10 @@ def find_surface_channel(lfp_data, ephys_params, params):
     }
 
     if save_figure:
-        plot_results(chunk, 
-                     power, 
-                     in_range, 
-                     values, 
+        plot_results(last_pass['chunk'], 
+                     last_pass['power'], 
+                     last_pass['in_range'], 
+                     last_pass['values'], 
                      nchannels, 
                      surface_channel, 
                      power_thresh, 
@@ -176,6 +209,48 @@ def find_surface_channel(lfp_data, ephys_params, params):
 
 
 
+def subtract_lfp_medians(lfp_chunk, channel_range):
+
+    """
+    Removes the offset of each channel and the median of the reference channels
+
+    Same result as subtracting each channel's median, then, one channel at a
+    time in ascending order, the median across channel_range at each sample.
+    Because channels within channel_range are re-referenced in that loop,
+    the reference changes while they are processed; only those channels are
+    handled one at a time here.
+
+    Inputs:
+    ------
+    lfp_chunk : numpy.ndarray (N samples x M channels)
+        int16 LFP band data
+    channel_range : array-like
+        First and last (exclusive) channels of the reference
+
+    Outputs:
+    -------
+    chunk : numpy.ndarray (N samples x M channels)
+        int16 re-referenced data
+
+    """
+
+    chunk = np.array(lfp_chunk)
+
+    chunk[:,:] = chunk - np.median(chunk,0)
+
+    first_channel, last_channel = int(channel_range[0]), int(channel_range[1])
+
+    chunk[:,:first_channel] = chunk[:,:first_channel] - np.median(chunk[:,first_channel:last_channel],1)[:,np.newaxis]
+
+    for ch in np.arange(first_channel, np.min([last_channel, chunk.shape[1]])):
+        chunk[:,ch] = chunk[:,ch] - np.median(chunk[:,first_channel:last_channel],1)
+
+    chunk[:,last_channel:] = chunk[:,last_channel:] - np.median(chunk[:,first_channel:last_channel],1)[:,np.newaxis]
+
+    return chunk
+
+
+
 def plot_results(chunk, 
                  power, 
                  in_range, 
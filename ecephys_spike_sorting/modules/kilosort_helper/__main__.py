@@ -11,11 +11,10 @@ import numpy as np
 
 from pathlib import Path
 
-from scipy.signal import butter, filtfilt, medfilt
-
 from . import matlab_file_generator
 from .SGLXMetaToCoords import MetaToCoords
-from ...common.utils import read_probe_json, get_repo_commit_date_and_hash, rms, getSortResults
+from .noise_channels import get_noise_channels
+from ...common.utils import read_probe_json, get_repo_commit_date_and_hash, getSortResults
 
 def run_kilosort(args):
 
@@ -36,7 +35,9 @@ def run_kilosort(args):
     mask = get_noise_channels(args['ephys_params']['ap_band_file'],
                               args['ephys_params']['num_channels'],
                               args['ephys_params']['sample_rate'],
-                              args['ephys_params']['bit_volts'])
+                              args['ephys_params']['bit_volts'],
+                              num_windows = args['kilosort_helper_params']['noise_detection_windows'],
+                              num_threads = args['kilosort_helper_params']['noise_detection_threads'])
      
     
     if args['kilosort_helper_params']['spikeGLX_data']:
@@ -192,45 +193,6 @@ def run_kilosort(args):
             "nTemplate" : nTemplate,
             "nTot" : nTot } # output manifest
 
-def get_noise_channels(raw_data_file, num_channels, sample_rate, bit_volts, noise_threshold=20):
-
-    noise_delay = 5            #in seconds
-    noise_interval = 10         #in seconds
-    
-    raw_data = np.memmap(raw_data_file, dtype='int16')
-    
-    num_samples = int(raw_data.size/num_channels)
-      
-    data = np.reshape(raw_data, (num_samples, num_channels))
-   
-    start_index = int(noise_delay * sample_rate)
-    end_index = int((noise_delay + noise_interval) * sample_rate)
-    
-    if end_index > num_samples:
-        print('noise interval larger than total number of samples')
-        end_index = num_samples
-        
-    uplim = 10000/(sample_rate/2);
-    if uplim >= 1:
-        uplim = 0.99;
-    
-    b, a = butter(3, [10/(sample_rate/2), uplim], btype='band')
-
-    D = data[start_index:end_index, :] * bit_volts
-    
-    D_filt = np.zeros(D.shape)  # datatype set by D
-
-    for i in range(D.shape[1]):
-        D_filt[:,i] = filtfilt(b, a, D[:,i])
-
-    rms_values = np.apply_along_axis(rms, axis=0, arr=D_filt)
-
-    above_median = rms_values - medfilt(rms_values,11)
-    
-    print('number of noise channels: ' + repr(sum(above_median > noise_threshold)))
-
-    return above_median < noise_threshold
-
 def fix_phy_params(output_dir, dat_path, dat_name, chan_phy_binary, sample_rate):
 
     # write a new params.py file. 
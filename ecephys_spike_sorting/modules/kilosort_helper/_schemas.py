@@ -60,6 +60,9 @@ class KilosortHelperParameters(DefaultSchema):
 
     surface_channel_buffer = Int(required=False, default=15, help='Number of channels above brain surface to include in spike sorting')
 
+    noise_detection_windows = Int(required=False, default=1, help='Number of 10 s windows, spread across the recording, used to find noise channels')
+    noise_detection_threads = Int(required=False, default=1, help='Number of threads used to filter data when finding noise channels')
+
     matlab_home_directory = InputDir(help='Location from which Matlab files can be copied and run.')
     kilosort_repository = InputDir(help='Local directory for the Kilosort source code repository.')
     npy_matlab_repository = InputDir(help='Local directory for the npy_matlab repo for writing phy output')
@@ -0,0 +1,129 @@
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from scipy.signal import butter, sosfiltfilt, medfilt
+
+
+def get_noise_channels(raw_data_file, num_channels, sample_rate, bit_volts, noise_threshold=20,
+                       num_windows = 1,
+                       noise_delay = 5,
+                       noise_interval = 10,
+                       num_threads = 1,
+                       channels_per_block = 32):
+
+    """
+    Finds channels with a much higher RMS than their neighbors
+
+    The AP band is band-pass filtered (10 Hz - 10 kHz) in one or more windows
+    of noise_interval seconds. In each window, a channel's excess noise is its
+    RMS minus the median RMS of the 11 channels around it. With more than one
+    window, the excess noise is the median across windows, so a transient
+    artifact in one window doesn't mark a channel as noisy.
+
+    Each window is read as float32 and filtered along the time axis in blocks
+    of channels_per_block channels; blocks are independent and are run on a
+    pool of num_threads threads (the filter releases the GIL).
+
+    Inputs:
+    -------
+    raw_data_file : String
+        Path to int16 AP band file
+    num_channels : Int
+        Total number of channels in the file
+    sample_rate : Float
+        Sample rate (Hz)
+    bit_volts : Float
+        uV per bit
+    noise_threshold : Float
+        Excess RMS (uV) above which a channel is marked as noise
+    num_windows : Int
+        Number of windows, spread evenly from noise_delay to the end of the
+        recording (1 = a single window starting at noise_delay)
+    noise_delay : Float
+        Start of the first window (s)
+    noise_interval : Float
+        Length of each window (s)
+    num_threads : Int
+        Number of threads for filtering
+    channels_per_block : Int
+        Channels filtered together in one task
+
+    Outputs:
+    --------
+    mask : numpy.ndarray (num_channels x 0)
+        False for noise channels, True otherwise
+
+    """
+
+    raw_data = np.memmap(raw_data_file, dtype='int16')
+
+    num_samples = int(raw_data.size/num_channels)
+
+    data = np.reshape(raw_data[:num_samples * num_channels], (num_samples, num_channels))
+
+    windows = get_noise_windows(num_samples, sample_rate, num_windows, noise_delay, noise_interval)
+
+    uplim = 10000/(sample_rate/2);
+    if uplim >= 1:
+        uplim = 0.99;
+
+    sos = butter(3, [10/(sample_rate/2), uplim], btype='band', output='sos')
+
+    blocks = [(window_idx, channel_start) for window_idx in range(len(windows))
+                                          for channel_start in range(0, num_channels, channels_per_block)]
+
+    rms_values = np.zeros((len(windows), num_channels))
+
+    def filter_block(block):
+
+        window_idx, channel_start = block
+        start_index, end_index = windows[window_idx]
+        channel_end = np.min([channel_start + channels_per_block, num_channels])
+
+        D = data[start_index:end_index, channel_start:channel_end].astype('float32')
+        D *= np.float32(bit_volts)
+
+        D_filt = sosfiltfilt(sos, D, axis=0).astype('float32')
+
+        rms_values[window_idx, channel_start:channel_end] = np.sqrt(np.mean(np.square(D_filt), axis=0))
+
+    if num_threads > 1:
+        with ThreadPool(num_threads) as pool:
+            pool.map(filter_block, blocks)
+    else:
+        for block in blocks:
+            filter_block(block)
+
+    above_median = np.median([window_rms - medfilt(window_rms, 11) for window_rms in rms_values], axis=0)
+
+    print('number of noise channels: ' + repr(sum(above_median > noise_threshold)))
+
+    return above_median < noise_threshold
+
+
+def get_noise_windows(num_samples, sample_rate, num_windows, noise_delay, noise_interval):
+
+    """
+    Returns the (start, end) sample of each window used by get_noise_channels
+
+    The first window starts at noise_delay and the last one ends at the end of
+    the recording, with the rest evenly spaced between them. Windows are
+    clipped to the recording, and overlap if it is too short to fit them all.
+
+    """
+
+    window_samples = int(noise_interval * sample_rate)
+    first_start = int(noise_delay * sample_rate)
+
+    if first_start + window_samples > num_samples:
+        print('noise interval larger than total number of samples')
+        return [(np.min([first_start, num_samples]), num_samples)]
+
+    if num_windows > 1:
+        starts = np.linspace(first_start, num_samples - window_samples, num_windows).astype('int64')
+        starts = np.unique(starts)
+    else:
+        starts = [first_start]
+
+    return [(int(start), int(start) + window_samples) for start in starts]
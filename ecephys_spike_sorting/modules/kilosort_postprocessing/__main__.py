@@ -6,9 +6,9 @@ import time
 
 import numpy as np
 
-from ...common.utils import load_kilosort_data, getSortResults
+from ...common.utils import KilosortData, getSortResults
 
-from .postprocessing import remove_double_counted_spikes
+from .postprocessing import find_double_counted_spikes, remove_spikes, remove_spikes_from_npy
 
 def run_postprocessing(args):
 
@@ -23,43 +23,35 @@ def run_postprocessing(args):
     
     include_pcs = args['ks_postprocessing_params']['include_pcs']
     
-    if include_pcs:
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                    load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                        args['ephys_params']['sample_rate'], \
-                        convert_to_seconds = False, \
-                        use_master_clock = False, \
-                        include_pcs = include_pcs )
-    else:
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
-                    load_kilosort_data(args['directories']['kilosort_output_directory'], \
+    data = KilosortData(args['directories']['kilosort_output_directory'], \
                         args['ephys_params']['sample_rate'], \
                         convert_to_seconds = False, \
-                        use_master_clock = False, \
-                        include_pcs = include_pcs )
-        # empty arrays to stand in for the missing variables
-        pc_features = []
-        pc_feature_ind = []
-        template_features = []
-        
-
-    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, \
-    template_features, overlap_matrix, overlap_summary = \
-        remove_double_counted_spikes(spike_times, 
-                                     spike_clusters,
-                                     spike_templates, 
-                                     amplitudes, 
-                                     channel_map,
-                                     channel_pos,
-                                     templates, 
-                                     pc_features, 
-                                     pc_feature_ind, 
-                                     template_features,
-                                     cluster_amplitude,
-                                     args['ephys_params']['sample_rate'],
-                                     args['ks_postprocessing_params'])
+                        use_master_clock = False)
+
+    spikes_to_remove, overlap_matrix, overlap_summary = \
+        find_double_counted_spikes(data.spike_times, 
+                                   data.spike_clusters,
+                                   data.channel_map,
+                                   data.channel_pos,
+                                   data.templates, 
+                                   data.cluster_amplitude,
+                                   args['ephys_params']['sample_rate'],
+                                   args['ks_postprocessing_params'])
+
+    # pc_features and template_features are filtered on disk below, so 
+    # only the per-spike vectors are edited in memory
+    spike_times, spike_clusters, spike_templates, amplitudes, _, _ = \
+        remove_spikes(data.spike_times, 
+                      data.spike_clusters,
+                      data.spike_templates, 
+                      data.amplitudes, 
+                      [], 
+                      [], 
+                      spikes_to_remove, 
+                      False)
+
+    # release any memory maps before the files are overwritten
+    data.clear()
 
     print("Saving data...")
 
@@ -70,9 +62,11 @@ def run_postprocessing(args):
     np.save(os.path.join(output_dir, 'spike_clusters.npy'), spike_clusters)
     np.save(os.path.join(output_dir, 'spike_templates.npy'), spike_templates)
     
-    if args['ks_postprocessing_params']['include_pcs']:
-        np.save(os.path.join(output_dir, 'pc_features.npy'), pc_features)
-        np.save(os.path.join(output_dir, 'template_features.npy'), template_features)
+    if include_pcs:
+        # streamed through a keep-mask in chunks, so memory use does not 
+        # depend on the size of these files
+        remove_spikes_from_npy(os.path.join(output_dir, 'pc_features.npy'), spikes_to_remove)
+        remove_spikes_from_npy(os.path.join(output_dir, 'template_features.npy'), spikes_to_remove)
         
     np.save(os.path.join(output_dir, 'overlap_matrix.npy'), overlap_matrix)
     np.save(os.path.join(output_dir, 'overlap_summary.npy'), overlap_summary)
@@ -1,8 +1,11 @@
+import os
 import numpy as np
 import pandas as pd
 from collections import OrderedDict
 
 from ...common.utils import printProgressBar
+from ...common.spike_groups import SpikeGroups
+from ...common.channel_neighbors import ChannelNeighbors
 
 def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates, 
                                  amplitudes, channel_map, channel_pos, templates, pc_features, 
@@ -62,6 +65,65 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
     """
     include_pcs = params['include_pcs']
 
+    spikes_to_remove, overlap_matrix, overlap_summary = find_double_counted_spikes(spike_times,
+                                                                                   spike_clusters,
+                                                                                   channel_map,
+                                                                                   channel_pos,
+                                                                                   templates,
+                                                                                   cluster_amplitude,
+                                                                                   sample_rate,
+                                                                                   params)
+
+    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times, 
+                                                                         spike_clusters,
+                                                                         spike_templates, 
+                                                                         amplitudes, 
+                                                                         pc_features, 
+                                                                         template_features, 
+                                                                         spikes_to_remove,
+                                                                         include_pcs)
+
+    return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, overlap_matrix, overlap_summary
+
+
+def find_double_counted_spikes(spike_times, spike_clusters, channel_map, channel_pos, 
+                               templates, cluster_amplitude, sample_rate, params):
+
+    """ Find putative double-counted spikes in Kilosort outputs, without removing them
+
+    Used by remove_double_counted_spikes; call this directly to remove the 
+    spikes from large files on disk (see remove_spikes_from_npy).
+
+    Inputs:
+    ------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in samples 
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    channel_map : numpy.ndarray (num_units x 0)
+        Original data channel for pc_feature_ind array
+    channel_pos : numpy.ndarray (num_channels x 2)
+        X and Z coordinates for each channel used in the sort    
+    templates : numpy.ndarray (num_units x num_channels x num_samples)
+        Spike templates for each unit
+    cluster_amplitude : numpy.ndarray (num_units x 0)
+        Mean amplitude of each unit
+    sample_rate : Float
+        Sample rate of spike times
+    params : dict of parameters (see remove_double_counted_spikes)
+
+    Outputs:
+    --------
+    spikes_to_remove : numpy.ndarray
+        Sorted indices (into the input arrays) of spikes to remove
+    overlap_matrix : numpy.ndarray (num_clusters x num_clusters)
+        Matrix indicating number of spikes removed for each pair of clusters
+    overlap_summary : numpy.ndarray (num_clusters x 5)
+        Unit ID, remaining spikes, within-unit, between-unit removals and 
+        the unit with the most overlaps, for each unit
+
+    """
+
     peak_chan_idx = np.squeeze(np.argmax(np.max(templates,1) - np.min(templates,1),1))
 
     # to accomdate case where matlab writes out chan map as (1,nchan) instead of (nchan,1)
@@ -76,92 +138,194 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
     
     sorted_unit_list = unit_list[order]
 
+    # position of each unit in sorted_unit_list (rows / columns of overlap_matrix)
+    unit_rank = np.zeros((num_clusters,), dtype = 'int')
+    unit_rank[sorted_unit_list] = np.arange(num_clusters)
+
     overlap_matrix = np.zeros((num_clusters, num_clusters), dtype = 'int')
-    
 
     within_unit_overlap_samples = int(params['within_unit_overlap_window'] * sample_rate)
     between_unit_overlap_samples = int(params['between_unit_overlap_window'] * sample_rate)
 
-    print('Removing within-unit overlapping spikes...')
+    print('Finding within-unit overlapping spikes...')
 
-    spikes_to_remove = np.zeros((0,), dtype = 'int')
+    within_unit_spikes = find_within_unit_overlaps(spike_times, spike_clusters, num_clusters, within_unit_overlap_samples)
 
-    for idx1, unit_id1 in enumerate(sorted_unit_list):
+    overlap_matrix[unit_rank, unit_rank] = np.bincount(spike_clusters[within_unit_spikes], minlength = num_clusters)[:num_clusters]
 
-        printProgressBar(idx1+1, len(unit_list))
+    # the between-unit pass sees only the spikes that are left
+    remaining = np.ones((spike_times.size,), dtype = 'bool')
+    remaining[within_unit_spikes] = False
+    remaining = np.where(remaining)[0]
 
-        for_unit1 = np.where(spike_clusters == unit_id1)[0]
+    print('Finding between-unit overlapping spikes...')
 
-        to_remove = find_within_unit_overlap(spike_times[for_unit1], within_unit_overlap_samples)
+    # neighbour table: units whose peak channels are closer than between_unit_dist_um
+    neighbors = ChannelNeighbors(channel_pos).neighbor_table(peak_chan_idx[:num_clusters], params['between_unit_dist_um'])
+    np.fill_diagonal(neighbors, False)
 
-        overlap_matrix[idx1, idx1] = len(to_remove)
+    first_spikes, second_spikes = find_between_unit_overlaps(spike_times[remaining], 
+                                                             spike_clusters[remaining], 
+                                                             unit_rank, 
+                                                             neighbors, 
+                                                             between_unit_overlap_samples)
 
-        spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove]))
+    first_spikes = remaining[first_spikes]
+    second_spikes = remaining[second_spikes]
 
-    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times, 
-                                                                        spike_clusters, 
-                                                                        spike_templates, 
-                                                                        amplitudes, 
-                                                                        pc_features, 
-                                                                        template_features, 
-                                                                        spikes_to_remove,
-                                                                        include_pcs)
-
-    print('Removing between-unit overlapping spikes...')
-
-    spikes_to_remove = np.zeros((0,), dtype = 'int')
-
-    for idx1, unit_id1 in enumerate(sorted_unit_list):
-
-        printProgressBar(idx1+1, len(unit_list))
-
-        for_unit1 = np.where(spike_clusters == unit_id1)[0]
-        
-        for idx2, unit_id2 in enumerate(unit_list[order]):
-            
-            deltaX = np.squeeze(channel_pos[peak_chan_idx[unit_id2],0] - channel_pos[peak_chan_idx[unit_id1],0])
-            deltaZ = np.squeeze(channel_pos[peak_chan_idx[unit_id2],1] - channel_pos[peak_chan_idx[unit_id1],1])
-            
-            dist = pow( (pow(deltaX,2) + pow(deltaZ,2)), 0.5 )
-            
-            if idx2 > idx1 and dist < params['between_unit_dist_um']:
-                
-                amp1 = cluster_amplitude[unit_id1]
-                amp2 = cluster_amplitude[unit_id2]
-                
-                for_unit2 = np.where(spike_clusters == unit_id2)[0]
+    first_units = spike_clusters[first_spikes]
+    second_units = spike_clusters[second_spikes]
 
-                to_remove1, to_remove2 = find_between_unit_overlap(spike_times[for_unit1], spike_times[for_unit2], amp1, amp2, between_unit_overlap_samples, params['deletion_mode'] )
-
-                overlap_matrix[idx1, idx2] = overlap_matrix[idx1, idx2] + len(to_remove1) 
-                overlap_matrix[idx2, idx1] = overlap_matrix[idx2, idx1] + len(to_remove2)
+    if params['deletion_mode'] == 'deleteFirst':
+        # always remove the later spike of each pair
+        removed_units = second_units
+        kept_units = first_units
+        between_unit_spikes = second_spikes
+    else:
+        # remove spikes from the unit with lower amplitude; on a tie, the unit 
+        # later in sorted_unit_list loses
+        unit1 = np.where(unit_rank[first_units] < unit_rank[second_units], first_units, second_units)
+        unit2 = np.where(unit1 == first_units, second_units, first_units)
+        removed_units = np.where(cluster_amplitude[unit1] < cluster_amplitude[unit2], unit1, unit2)
+        kept_units = np.where(removed_units == unit1, unit2, unit1)
+        between_unit_spikes = np.where(removed_units == first_units, first_spikes, second_spikes)
 
-                spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove1], for_unit2[to_remove2]))
+    np.add.at(overlap_matrix, (unit_rank[removed_units], unit_rank[kept_units]), 1)
 
+    spikes_to_remove = np.unique(np.concatenate((within_unit_spikes, between_unit_spikes)))
 
-    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times, 
-                                                                         spike_clusters,
-                                                                         spike_templates, 
-                                                                         amplitudes, 
-                                                                         pc_features, 
-                                                                         template_features, 
-                                                                         np.unique(spikes_to_remove),
-                                                                         include_pcs)
 #   build overlap summary 
+    spike_counts = np.bincount(np.delete(spike_clusters, spikes_to_remove), minlength = num_clusters)
     overlap_summary = np.zeros((num_clusters, 5), dtype=int )
-    for idx1, unit_id1 in enumerate(unit_list[order]):
-        overlap_summary[idx1,0] = unit_id1
-        overlap_summary[idx1,1] = np.sum(spike_clusters == unit_id1)
-        overlap_summary[idx1,2] = overlap_matrix[idx1,idx1]
-        overlap_summary[idx1,3] = np.sum(overlap_matrix[idx1,:]) - overlap_matrix[idx1,idx1]
-        overlap_summary[idx1,4] = sorted_unit_list[np.argmax(overlap_matrix[idx1,:])]     
+    overlap_summary[:,0] = sorted_unit_list
+    overlap_summary[:,1] = spike_counts[sorted_unit_list]
+    overlap_summary[:,2] = np.diag(overlap_matrix)
+    overlap_summary[:,3] = np.sum(overlap_matrix, 1) - np.diag(overlap_matrix)
+    overlap_summary[:,4] = sorted_unit_list[np.argmax(overlap_matrix, 1)]
 #   sort by label
     new_order = np.argsort(overlap_summary[:,0])
     overlap_summary = overlap_summary[new_order,:]
 
-    return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, overlap_matrix, overlap_summary
+    return spikes_to_remove, overlap_matrix, overlap_summary
 
                 
+def find_within_unit_overlaps(spike_times, spike_clusters, num_clusters, overlap_window = 5):
+
+    """
+    Finds overlapping spikes within every unit in one pass
+
+    Equivalent to calling find_within_unit_overlap on the spike train of 
+    each unit, but spikes are grouped with a single stable sort instead of 
+    one np.where per unit.
+
+    Parameters
+    ----------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times (in samples)
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    num_clusters : int
+        Only units with IDs below this value are checked
+    overlap_window : int
+        Number of samples to search for overlapping spikes
+
+    Outputs
+    -------
+    spikes_to_remove : numpy.ndarray
+        Indices of overlapping spikes (the earlier spike of each pair)
+
+    """
+
+    spike_groups = SpikeGroups(spike_clusters, num_clusters)
+
+    sorted_times = spike_groups.sort(spike_times)
+    sorted_clusters = spike_groups.sort(spike_clusters)
+
+    overlapping = (np.diff(sorted_times) < overlap_window) * \
+                  (sorted_clusters[1:] == sorted_clusters[:-1]) * \
+                  (sorted_clusters[:-1] < num_clusters)
+
+    return np.sort(spike_groups.order[:-1][overlapping])
+
+
+def find_between_unit_overlaps(spike_times, spike_clusters, unit_rank, neighbors, overlap_window = 5):
+
+    """
+    Finds overlapping spikes between all pairs of neighbouring units in one 
+    sweep over the time-sorted spike train
+
+    For every pair of neighbouring units, this returns the same pairs of 
+    spikes as find_between_unit_overlap applied to the two spike trains: 
+    spikes from different units that are closer than overlap_window and 
+    have no spike from either unit in between. Like find_between_unit_overlap, 
+    it assumes same-unit overlaps were already removed (i.e. that 
+    within_unit_overlap_window >= between_unit_overlap_window).
+
+    Parameters
+    ----------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times (in samples)
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    unit_rank : numpy.ndarray (num_units x 0)
+        Order in which units are paired; spikes at identical times are 
+        ordered by this rank, as in a stable merge of the two trains
+    neighbors : numpy.ndarray (num_units x num_units)
+        Boolean neighbour table, True for unit pairs to compare
+    overlap_window : int
+        Number of samples to search for overlapping spikes
+
+    Outputs
+    -------
+    first_spikes : numpy.ndarray
+        Indices of the earlier spike of each overlapping pair
+    second_spikes : numpy.ndarray
+        Indices of the later spike of each overlapping pair
+
+    """
+
+    spike_inds = np.where(spike_clusters < unit_rank.size)[0]
+
+    units = spike_clusters[spike_inds]
+    times = spike_times[spike_inds].astype('int64')
+
+    order = np.lexsort((spike_inds, unit_rank[units], times))
+
+    spike_inds = spike_inds[order]
+    units = units[order]
+    times = times[order]
+
+    first_spikes = []
+    second_spikes = []
+
+    # look ahead one spike at a time; since times are sorted, once no spike 
+    # is within the window at offset k there are none at offset k + 1
+    for k in range(1, times.size):
+
+        candidates = np.where(times[k:] - times[:-k] < overlap_window)[0]
+
+        if candidates.size == 0:
+            break
+
+        unit1 = units[candidates]
+        unit2 = units[candidates + k]
+
+        is_overlap = (unit1 != unit2) * neighbors[unit1, unit2]
+
+        # spikes must be adjacent in the merged train of the two units
+        for m in range(1, k):
+            between = units[candidates + m]
+            is_overlap *= (between != unit1) * (between != unit2)
+
+        first_spikes.append(spike_inds[candidates[is_overlap]])
+        second_spikes.append(spike_inds[candidates[is_overlap] + k])
+
+    if len(first_spikes) == 0:
+        return np.zeros((0,), dtype = 'int'), np.zeros((0,), dtype = 'int')
+
+    return np.concatenate(first_spikes), np.concatenate(second_spikes)
+
+
 def find_within_unit_overlap(spike_train, overlap_window = 5):
 
     """
@@ -302,3 +466,54 @@ def remove_spikes(spike_times, spike_clusters, spike_templates, amplitudes, pc_f
 
     return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features
 
+
+def remove_spikes_from_npy(filename, spikes_to_remove, max_buffer_bytes = 2.5e8):
+
+    """
+    Removes rows from a (num_spikes x ...) .npy file without loading it
+
+    The file is streamed through a keep-mask in chunks of rows and written 
+    to a temporary .npy, which then replaces the original. Peak memory is 
+    bounded by max_buffer_bytes regardless of the file size.
+
+    Inputs:
+    ------
+    filename : str
+        Path to .npy file with one row per spike (e.g. pc_features.npy)
+    spikes_to_remove : numpy.ndarray
+        Indices of rows to remove
+    max_buffer_bytes : float
+        Size of the chunks that are read and written
+
+    """
+
+    data = np.load(filename, mmap_mode = 'r')
+
+    keep = np.ones((data.shape[0],), dtype = 'bool')
+    keep[spikes_to_remove] = False
+
+    temp_file = filename + '.tmp'
+
+    output = np.lib.format.open_memmap(temp_file, mode = 'w+', dtype = data.dtype, 
+                                       shape = (int(np.sum(keep)),) + data.shape[1:])
+
+    row_bytes = data.dtype.itemsize * int(np.prod(data.shape[1:]))
+    rows_per_chunk = int(np.max([1, max_buffer_bytes // np.max([1, row_bytes])]))
+
+    output_row = 0
+
+    for start in range(0, data.shape[0], rows_per_chunk):
+
+        end = np.min([start + rows_per_chunk, data.shape[0]])
+
+        chunk = data[start:end][keep[start:end]]
+
+        output[output_row:output_row + chunk.shape[0]] = chunk
+        output_row += chunk.shape[0]
+
+    output.flush()
+
+    # close both memory maps before the original file is replaced
+    del output, data
+
+    os.replace(temp_file, filename)
@@ -8,7 +8,8 @@ import numpy as np
 import pandas as pd
 from scipy.io import loadmat
 
-from ...common.utils import load_kilosort_data
+from ...common.utils import KilosortData
+from ...common.metrics_table import read_metrics, write_metrics, merge_metrics, get_metrics_format
 
 from .extract_waveforms import extract_waveforms, writeDataAsNpy
 from .waveform_metrics import calculate_waveform_metrics
@@ -60,14 +61,9 @@ def calculate_mean_waveforms(args):
         # C_Waves writes out files of the waveforms and snr
         # call version of calculate_waveform_metrics that will use these files
         # load in kilosort output needed for these calculations
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
-                load_kilosort_data(args['directories']['kilosort_output_directory'], \
+        ks_data = KilosortData(args['directories']['kilosort_output_directory'], \
                     args['ephys_params']['sample_rate'], \
                     convert_to_seconds = False)
-                
-        # read in inverse of whitening matrix
-        w_inv = np.load((os.path.join(args['directories']['kilosort_output_directory'], 'whitening_mat_inv.npy')))
         
         # the channel_pos loaded from the phy output omits any sites excluded
         # as noise by the kilosort_helper module, or excluded fow low spike rete
@@ -88,18 +84,17 @@ def calculate_mean_waveforms(args):
         snr_fullpath = os.path.join(dest, 'cluster_snr.npy')
                 
         metrics = metrics_from_file(mean_waveform_fullpath, snr_fullpath, \
-                    spike_times, \
-                    spike_clusters, \
-                    templates, \
-                    channel_map, \
+                    ks_data.spike_times, \
+                    ks_data.spike_clusters, \
+                    ks_data.peak_channel_idx, \
+                    ks_data.channel_map, \
                     args['ephys_params']['bit_volts'], \
                     args['ephys_params']['sample_rate'], \
                     args['ephys_params']['vertical_site_spacing'], \
-                    w_inv, \
                     site_x, site_y, \
                     args['mean_waveform_params'])
                 
-        metrics.to_csv(args['waveform_metrics']['waveform_metrics_file'])      
+        write_metrics(metrics, args['waveform_metrics']['waveform_metrics_file'])      
         
     else:
         
@@ -109,36 +104,33 @@ def calculate_mean_waveforms(args):
         rawData = np.memmap(args['ephys_params']['ap_band_file'], dtype='int16', mode='r')
         data = np.reshape(rawData, (int(rawData.size/args['ephys_params']['num_channels']), args['ephys_params']['num_channels']))
     
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
-                load_kilosort_data(args['directories']['kilosort_output_directory'], \
+        ks_data = KilosortData(args['directories']['kilosort_output_directory'], \
                     args['ephys_params']['sample_rate'], \
                     convert_to_seconds = False)
     
         print("Calculating mean waveforms...")
     
-        waveforms, spike_counts, coords, labels, metrics = extract_waveforms(data, spike_times, \
-                    spike_clusters,
-                    templates,
-                    channel_map,
+        waveforms, spike_counts, coords, labels, metrics = extract_waveforms(data, ks_data.spike_times, \
+                    ks_data.spike_clusters,
+                    ks_data.templates,
+                    ks_data.channel_map,
                     args['ephys_params']['bit_volts'], \
                     args['ephys_params']['sample_rate'], \
                     args['ephys_params']['vertical_site_spacing'], \
-                    args['mean_waveform_params'])
+                    args['mean_waveform_params'],
+                    raw_data_offset = 0)
     
         writeDataAsNpy(waveforms, args['mean_waveform_params']['mean_waveforms_file'])
-        metrics.to_csv(args['waveform_metrics']['waveform_metrics_file'])
+        write_metrics(metrics, args['waveform_metrics']['waveform_metrics_file'])
 
 
     # if the cluster metrics have already been run, merge the waveform metrics into that file
     if os.path.exists(args['cluster_metrics']['cluster_metrics_file']):
-        qmetrics = pd.read_csv(args['cluster_metrics']['cluster_metrics_file'])
-        qmetrics = qmetrics.drop(qmetrics.columns[0], axis='columns')
-        qmetrics = qmetrics.merge(pd.read_csv(args['waveform_metrics']['waveform_metrics_file'], index_col=0),
-                     on='cluster_id',
-                     suffixes=('_quality_metrics','_waveform_metrics'))  
+        qmetrics = read_metrics(args['cluster_metrics']['cluster_metrics_file'])
+        qmetrics = merge_metrics(qmetrics, read_metrics(args['waveform_metrics']['waveform_metrics_file']),
+                     columnar = get_metrics_format(args['cluster_metrics']['cluster_metrics_file']) != 'csv')
         print("Saving merged quality metrics ...")
-        qmetrics.to_csv(args['cluster_metrics']['cluster_metrics_file'])
+        write_metrics(qmetrics, args['cluster_metrics']['cluster_metrics_file'])
         
     execution_time = time.time() - start
 
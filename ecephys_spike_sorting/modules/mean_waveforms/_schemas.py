@@ -7,7 +7,7 @@ class MeanWaveformParams(DefaultSchema):
     samples_per_spike = Int(required=True, default=82, help='Number of samples to extract for each spike')
     pre_samples = Int(required=True, default=20, help='Number of samples between start of spike and the peak')
     num_epochs = Int(required=True, default=1, help='Number of epochs to compute mean waveforms')
-    spikes_per_epoch = Int(require=True, default=100, help='Max number of spikes per epoch')
+    spikes_per_epoch = Int(require=True, default=100, help='Max number of spikes per epoch (memory use does not grow with this number in python)')
     upsampling_factor = Float(require=False, default=200/82, help='Upsampling factor for calculating waveform metrics')
     spread_threshold = Float(require=False, default=0.12, help='Threshold for computing channel spread of 2D waveform')
     site_range = Int(require=False, default=16, help='Number of sites to use for 2D waveform metrics')
@@ -15,6 +15,8 @@ class MeanWaveformParams(DefaultSchema):
     use_C_Waves = Bool(require=False, default=False, help='Use faster C routine to calculate mean waveforms')
     snr_radius = Int(require=False, default=8, help='disk radius (chans) about pk-chan for snr calculation in C_waves')
     mean_waveforms_file = String(required=True, help='Path to mean waveforms file (.npy)')
+    multiprocessing_worker_count = Int(required=False, default=1, help='Number of worker processes for calculating mean waveforms in python (1 = serial)')
+    accumulator_dtype = String(required=False, default='float64', help='Precision of the running mean / std of waveforms in python (float32 or float64)')
 
 
 class InputParameters(ArgSchema):
@@ -1,14 +1,16 @@
 import numpy as np
 import os
 import glob
+import multiprocessing
 
 import xarray as xr
 import pandas as pd
 
 import warnings
 
-from .waveform_metrics import calculate_waveform_metrics
+from .waveform_metrics import calculate_waveform_metrics_from_stats
 from ...common.epoch import Epoch
+from ...common.spike_groups import SpikeGroups
 from ...common.utils import printProgressBar
 
 def extract_waveforms(raw_data, 
@@ -20,7 +22,9 @@ def extract_waveforms(raw_data,
                       sample_rate, 
                       site_spacing, 
                       params, 
-                      epochs=None):
+                      epochs=None,
+                      max_buffer_bytes=2e9,
+                      raw_data_offset=None):
     
     """
     Calculate mean waveforms for sorted units.
@@ -34,6 +38,12 @@ def extract_waveforms(raw_data,
     cluster_quality : 'noise' or 'good'
     sample_rate : Hz
     site_spacing : m
+    epochs : list of Epoch objects (optional)
+    max_buffer_bytes : size of the waveform read buffer (per process); spikes 
+        are read in chunks that fit within it
+    raw_data_offset : byte offset of raw_data[0,0] in its file, used by worker 
+        processes to open their own memory maps (optional; found from the 
+        memory map if not given)
 
     Outputs:
     -------
@@ -56,6 +66,10 @@ def extract_waveforms(raw_data,
     pre_samples : number of samples prior to peak
     num_epochs : number of epochs to calculate mean waveforms
     spikes_per_epoch : max number of spikes to generate average for epoch
+    multiprocessing_worker_count : number of worker processes (optional, default 1);
+        each opens its own memory map of raw_data, which must be an np.memmap
+    accumulator_dtype : 'float64' or 'float32' precision of the running 
+        mean / std (optional, default 'float64')
 
     """
 
@@ -68,10 +82,12 @@ def extract_waveforms(raw_data,
     upsampling_factor = params['upsampling_factor']
     spread_threshold = params['spread_threshold']
     site_range = params['site_range']
+    num_workers = params.get('multiprocessing_worker_count', 1)
+    accumulator_dtype = np.dtype(params.get('accumulator_dtype', 'float64'))
 
     # #############################################
 
-    metrics = pd.DataFrame()
+    unit_metrics_list = []
 
     if epochs is None:
         epochs = [Epoch('complete_session', 0, np.inf)]
@@ -87,70 +103,111 @@ def extract_waveforms(raw_data,
 
     peak_channels = np.squeeze(channel_map[np.argmax(np.max(templates,1) - np.min(templates,1),1)])
 
-    for epoch_idx, epoch in enumerate(epochs):
+    raw_data_file = getattr(raw_data, 'filename', None)
 
-        print("Epoch: " + epoch.name)
+    if num_workers > 1 and raw_data_offset is None and raw_data_file is not None:
+        raw_data_offset = get_memmap_offset(raw_data)
 
-        in_epoch = ((spike_times / sample_rate) > epoch.start_time) * ((spike_times / sample_rate) < epoch.end_time)
+    if num_workers > 1 and (raw_data_file is None or raw_data_offset is None):
+        print('Raw data is not a memory-mapped file; calculating mean waveforms serially.')
+        num_workers = 1
 
-        spike_times_in_epoch = spike_times[in_epoch]
+    num_workers = int(np.max([1, np.min([num_workers, multiprocessing.cpu_count()])]))
 
-        for cluster_idx, cluster_id in enumerate(cluster_ids):
+    # each read holds (spikes x channels x samples) raw samples plus their 
+    # scaled copy; with several workers the buffer is split between them
+    bytes_per_spike = raw_data.shape[1] * samples_per_spike * (raw_data.dtype.itemsize + accumulator_dtype.itemsize)
+    spikes_per_read = int(np.max([1, max_buffer_bytes // (bytes_per_spike * num_workers)]))
+    units_per_batch = int(np.max([1, spikes_per_read // spikes_per_epoch]))
 
-            printProgressBar(cluster_idx+1, total_units)
+    # contiguous blocks of raw data read for those spikes share the same budget
+    max_block_samples = int(np.max([samples_per_spike, max_buffer_bytes // (raw_data.shape[1] * raw_data.dtype.itemsize * num_workers)]))
 
-            in_cluster = (spike_clusters[in_epoch] == cluster_id)
+    settings = {'samples_per_spike' : samples_per_spike,
+                'pre_samples' : pre_samples,
+                'spikes_per_read' : spikes_per_read,
+                'max_block_samples' : max_block_samples,
+                'accumulator_dtype' : accumulator_dtype,
+                'bit_volts' : bit_volts,
+                'peak_channels' : peak_channels,
+                'channel_map' : channel_map,
+                'sample_rate' : sample_rate,
+                'upsampling_factor' : upsampling_factor,
+                'spread_threshold' : spread_threshold,
+                'site_range' : site_range,
+                'site_spacing' : site_spacing}
 
-            if np.sum(in_cluster) > 0:
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers,
+                                    initializer = init_waveform_worker,
+                                    initargs = (raw_data_file, raw_data.dtype, raw_data_offset, raw_data.shape, settings))
+    else:
+        pool = None
 
-                times_for_cluster = spike_times_in_epoch[in_cluster]
+    try:
+        for epoch_idx, epoch in enumerate(epochs):
 
-                waveforms = np.empty(
-                    (spikes_per_epoch, raw_data.shape[1], samples_per_spike))
-                waveforms[:] = np.nan
+            print("Epoch: " + epoch.name)
+
+            in_epoch = ((spike_times / sample_rate) > epoch.start_time) * ((spike_times / sample_rate) < epoch.end_time)
+
+            spike_times_in_epoch = spike_times[in_epoch]
+            spike_groups = SpikeGroups(spike_clusters[in_epoch], total_units)
+
+            # choose the spikes for every unit up front (same random draws as
+            # shuffling each unit's spike times in turn)
+            selected_times = []
+
+            for cluster_idx, cluster_id in enumerate(cluster_ids):
+
+                times_for_cluster = spike_times_in_epoch[spike_groups.indices(cluster_id)]
 
                 np.random.shuffle(times_for_cluster)
 
                 total_waveforms = np.min(
                     [times_for_cluster.size, spikes_per_epoch])
 
-                for wv_idx, peak_time in enumerate(times_for_cluster[:total_waveforms]):
-                    start = int(peak_time-pre_samples)
-                    end = start + samples_per_spike
-                    rawWaveform = raw_data[start:end, :].T
-
-                    # in case spike was at start or end of dataset
-                    if rawWaveform.shape[1] == samples_per_spike:
-                        waveforms[wv_idx, :, :] = rawWaveform * bit_volts
-
-                # concatenate to existing dataframe
-                metrics = pd.concat([metrics, calculate_waveform_metrics(waveforms[:total_waveforms, :, :],
-                                                                         cluster_id, 
-                                                                         peak_channels[cluster_idx], 
-                                                                         channel_map,
-                                                                         sample_rate, 
-                                                                         upsampling_factor,
-                                                                         spread_threshold,
-                                                                         site_range,
-                                                                         site_spacing,
-                                                                         epoch.name
-                                                                         )])
-
-                with warnings.catch_warnings():
-
-                    warnings.simplefilter("ignore", category=RuntimeWarning)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   0, :, :] = np.nanmean(waveforms, 0)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   1, :, :] = np.nanstd(waveforms, 0)
-
-                    # remove offset
-                    for channel in range(0, mean_waveforms.shape[3]):
-                        mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] = \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] - \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, 0]
-
-                spike_count[cluster_idx, epoch_idx] = total_waveforms
+                selected_times.append(times_for_cluster[:total_waveforms])
+
+            units_with_spikes = [idx for idx, times in enumerate(selected_times) if times.size > 0]
+
+            if pool is not None:
+                # keep batches small enough that every worker gets several
+                units_per_batch = int(np.max([1, np.min([units_per_batch, np.ceil(len(units_with_spikes) / (4 * num_workers))])]))
+
+            batches = [units_with_spikes[i:i + units_per_batch] for i in range(0, len(units_with_spikes), units_per_batch)]
+
+            tasks = [(epoch.name, [(cluster_idx, cluster_ids[cluster_idx], selected_times[cluster_idx]) for cluster_idx in batch]) for batch in batches]
+
+            if pool is not None:
+                results = pool.imap(waveform_batch_worker, tasks)
+            else:
+                results = (process_waveform_batch(raw_data, task, settings) for task in tasks)
+
+            units_done = 0
+
+            for batch_results in results:
+
+                for cluster_idx, unit_mean, unit_std, unit_metrics, total_waveforms in batch_results:
+
+                    unit_metrics_list.append(unit_metrics)
+
+                    mean_waveforms[cluster_idx, epoch_idx, 0, :, :] = unit_mean
+                    mean_waveforms[cluster_idx, epoch_idx, 1, :, :] = unit_std
+
+                    spike_count[cluster_idx, epoch_idx] = total_waveforms
+
+                units_done += len(batch_results)
+                printProgressBar(units_done, len(units_with_spikes))
+
+    finally:
+        # also stops the workers if a batch fails or the run is interrupted
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    # a single concat; appending unit by unit copies the table every time
+    metrics = pd.concat(unit_metrics_list) if unit_metrics_list else pd.DataFrame()
 
     dimCoords, dimLabels = generateDimLabels(
         cluster_ids, total_epochs, pre_samples, samples_per_spike, raw_data.shape[1], sample_rate)
@@ -158,6 +215,281 @@ def extract_waveforms(raw_data,
     return mean_waveforms, spike_count, dimCoords, dimLabels, metrics
 
 
+def process_waveform_batch(raw_data, task, settings):
+
+    """
+    Calculates mean waveforms and waveform metrics for a batch of units
+
+    Waveforms are read in chunks of at most settings['spikes_per_read'] 
+    spikes and folded into one WaveformAccumulator per unit, so memory 
+    does not grow with spikes_per_epoch.
+
+    Inputs:
+    -------
+    raw_data : continuous data as numpy array (samples x channels)
+    task : (epoch_name, [(cluster_idx, cluster_id, spike_times), ...])
+        Selected spike times (in samples) for each unit in the batch
+    settings : dict
+        Extraction and metric parameters (see extract_waveforms)
+
+    Outputs:
+    --------
+    results : list of (cluster_idx, mean, std, metrics, spike_count)
+        mean and std are (channels x samples), offset-corrected mean
+
+    """
+
+    epoch_name, units = task
+
+    samples_per_spike = settings['samples_per_spike']
+    spikes_per_read = settings['spikes_per_read']
+    dtype = settings['accumulator_dtype']
+
+    window_starts = np.concatenate([times for cluster_idx, cluster_id, times in units]).astype('int64') - settings['pre_samples']
+
+    batch_offsets = np.concatenate(([0], np.cumsum([times.size for cluster_idx, cluster_id, times in units])))
+
+    accumulators = [WaveformAccumulator((raw_data.shape[1], samples_per_spike), dtype) for unit in units]
+
+    for chunk_start in range(0, window_starts.size, spikes_per_read):
+
+        chunk_end = np.min([chunk_start + spikes_per_read, window_starts.size])
+
+        raw_waveforms, is_valid = gather_waveforms(raw_data, window_starts[chunk_start:chunk_end], samples_per_spike,
+                                                   max_block_samples = settings['max_block_samples'])
+
+        first_unit = np.searchsorted(batch_offsets, chunk_start, side = 'right') - 1
+        last_unit = np.searchsorted(batch_offsets, chunk_end, side = 'left')
+
+        for batch_idx in range(first_unit, last_unit):
+
+            rows = np.arange(np.max([batch_offsets[batch_idx], chunk_start]), 
+                             np.min([batch_offsets[batch_idx+1], chunk_end])) - chunk_start
+
+            # in case spike was at start or end of dataset, leave it out
+            rows = rows[is_valid[rows]]
+
+            waveforms = raw_waveforms[rows].astype(dtype)
+            waveforms *= settings['bit_volts']
+
+            accumulators[batch_idx].add(waveforms)
+
+    results = []
+
+    for batch_idx, (cluster_idx, cluster_id, times) in enumerate(units):
+
+        total_waveforms = times.size
+
+        unit_mean = accumulators[batch_idx].mean()
+        unit_std = accumulators[batch_idx].std()
+
+        unit_metrics = calculate_waveform_metrics_from_stats(unit_mean,
+                                                             unit_std,
+                                                             cluster_id, 
+                                                             settings['peak_channels'][cluster_idx], 
+                                                             settings['channel_map'],
+                                                             settings['sample_rate'], 
+                                                             settings['upsampling_factor'],
+                                                             settings['spread_threshold'],
+                                                             settings['site_range'],
+                                                             settings['site_spacing'],
+                                                             epoch_name
+                                                             )
+
+        # remove offset
+        unit_mean = unit_mean - unit_mean[:, :1]
+
+        results.append((cluster_idx, unit_mean, unit_std, unit_metrics, total_waveforms))
+
+    return results
+
+
+class WaveformAccumulator():
+
+    """
+    Running mean and variance of spike waveforms
+
+    Batches of waveforms are merged with the parallel form of Welford's 
+    algorithm (Chan et al., 1979), which keeps only the count, mean and 
+    sum of squared deviations (M2), i.e. O(channels x samples) memory 
+    per unit regardless of the number of spikes.
+
+    """
+
+    def __init__(self, shape, dtype = 'float64'):
+
+        """
+        shape : tuple
+            (channels x samples) shape of one waveform
+        dtype : str or numpy.dtype
+            Precision of the running statistics ('float32' or 'float64')
+        """
+
+        self.count = 0
+        self._mean = np.zeros(shape, dtype = dtype)
+        self._M2 = np.zeros(shape, dtype = dtype)
+
+
+    def add(self, waveforms):
+
+        """ Adds a batch of waveforms (spikes x channels x samples) """
+
+        n_b = waveforms.shape[0]
+
+        if n_b == 0:
+            return
+
+        waveforms = np.asarray(waveforms, dtype = self._mean.dtype)
+
+        mean_b = np.mean(waveforms, 0)
+        M2_b = np.sum(np.square(waveforms - mean_b), 0)
+
+        n_a = self.count
+        n = n_a + n_b
+
+        delta = mean_b - self._mean
+
+        self._mean += delta * (n_b / n)
+        self._M2 += M2_b + np.square(delta) * (n_a * n_b / n)
+        self.count = n
+
+
+    def mean(self):
+
+        """ Returns the mean waveform (NaN if no waveforms were added) """
+
+        if self.count == 0:
+            return np.full(self._mean.shape, np.nan)
+
+        return self._mean.copy()
+
+
+    def std(self):
+
+        """ Returns the standard deviation (ddof = 0) across waveforms """
+
+        if self.count == 0:
+            return np.full(self._M2.shape, np.nan)
+
+        return np.sqrt(self._M2 / self.count)
+
+
+_waveform_worker_data = {}
+
+def init_waveform_worker(raw_data_file, dtype, offset, shape, settings):
+
+    # every worker opens its own memory map of the same rows of the AP band file
+    _waveform_worker_data['raw_data'] = np.memmap(raw_data_file, dtype = dtype, mode = 'r', offset = offset, shape = shape)
+    _waveform_worker_data['settings'] = settings
+
+
+def get_memmap_offset(data):
+
+    """ Returns the byte offset of data[0,0] in its file, or None
+
+    data must be a memory map, or a C-contiguous view of one (e.g. a range
+    of rows). The offset attribute of a view is that of the original map,
+    so the offset is found from the start of the data in memory instead.
+
+    """
+
+    full = data
+
+    while isinstance(full.base, np.memmap):
+        full = full.base
+
+    if not data.flags.c_contiguous or not isinstance(full, np.memmap):
+        return None
+
+    return full.offset + np.byte_bounds(data)[0] - np.byte_bounds(full)[0]
+
+
+def waveform_batch_worker(task):
+
+    return process_waveform_batch(_waveform_worker_data['raw_data'], task, _waveform_worker_data['settings'])
+
+
+def gather_waveforms(raw_data, window_starts, samples_per_spike, max_gap = 3000, max_block_samples = None):
+
+    """
+    Extracts many spike windows from the raw data in file order
+
+    Windows are sorted by start sample and grouped into runs whose gaps are 
+    shorter than max_gap samples, and that span at most max_block_samples.
+    Each run is read from the (memory-mapped) data file as one contiguous 
+    block, and its windows are scattered into a preallocated output buffer 
+    with a single fancy-indexing operation.
+
+    Inputs:
+    -------
+    raw_data : continuous data as numpy array (samples x channels)
+    window_starts : numpy.ndarray (N x 0)
+        First sample of each window
+    samples_per_spike : int
+        Number of samples in each window
+    max_gap : int
+        Largest gap (in samples) between windows that are read together
+    max_block_samples : int (optional)
+        Largest block (in samples) read at once; a single window is always
+        read, however long it is
+
+    Outputs:
+    --------
+    waveforms : numpy.ndarray (N x channels x samples_per_spike)
+        Raw waveforms, in the order of window_starts (same dtype as raw_data)
+    is_valid : numpy.ndarray (N x 0)
+        False for windows that extend past the start or end of the data 
+        (these rows are left as zeros)
+
+    """
+
+    window_starts = np.asarray(window_starts, dtype='int64')
+
+    waveforms = np.zeros((window_starts.size, raw_data.shape[1], samples_per_spike), dtype=raw_data.dtype)
+
+    is_valid = (window_starts >= 0) * (window_starts + samples_per_spike <= raw_data.shape[0])
+
+    valid_inds = np.where(is_valid)[0]
+    order = valid_inds[np.argsort(window_starts[valid_inds], kind='stable')]
+    sorted_starts = window_starts[order]
+
+    # a new run begins wherever the gap to the previous window is too large
+    run_breaks = np.where(np.diff(sorted_starts) > max_gap)[0] + 1
+    run_bounds = np.concatenate(([0], run_breaks, [sorted_starts.size]))
+
+    if max_block_samples is None:
+        max_block_samples = raw_data.shape[0]
+
+    # runs of dense windows are split further, so each block fits the budget
+    max_start_offset = np.max([0, max_block_samples - samples_per_spike])
+
+    sample_offsets = np.arange(samples_per_spike)
+
+    for run_start, run_end in zip(run_bounds[:-1], run_bounds[1:]):
+
+        block_start = run_start
+
+        while block_start < run_end:
+
+            block_end = np.searchsorted(sorted_starts[block_start:run_end], 
+                                        sorted_starts[block_start] + max_start_offset, 
+                                        side = 'right') + block_start
+
+            first_sample = sorted_starts[block_start]
+            last_sample = sorted_starts[block_end-1] + samples_per_spike
+
+            block = np.asarray(raw_data[first_sample:last_sample, :])
+
+            rows = (sorted_starts[block_start:block_end] - first_sample)[:,np.newaxis] + sample_offsets
+
+            # (windows x samples x channels) -> (windows x channels x samples)
+            waveforms[order[block_start:block_end]] = np.transpose(block[rows, :], (0, 2, 1))
+
+            block_start = block_end
+
+    return waveforms, is_valid
+
+
 def generateDimLabels(good_clusters, num_epochs, pre_samples, total_samples, num_channels, sample_rate):
     """ Generate dimension labels and coordinates for the xarray """
 
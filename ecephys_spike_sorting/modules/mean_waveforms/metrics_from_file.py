@@ -10,17 +10,17 @@ import warnings
 from .waveform_metrics import calculate_waveform_metrics_from_avg
 from ...common.epoch import Epoch
 from ...common.utils import printProgressBar
+from ...common.channel_neighbors import ChannelNeighbors
 
 def metrics_from_file(mean_waveform_fullpath,
                       snr_fullpath,
                       spike_times, 
                       spike_clusters, 
-                      templates, 
+                      peak_channel_idx, 
                       channel_map, 
                       bit_volts, 
                       sample_rate, 
                       site_spacing, 
-                      w_inv,
                       site_x,
                       site_y,
                       params):
@@ -36,11 +36,12 @@ def metrics_from_file(mean_waveform_fullpath,
     snr_fullpath: path to snr npy file
     spike_times : spike times (in samples)
     spike_clusters : cluster IDs for each spike time []
+    peak_channel_idx : index into channel_map of each template's peak channel
+        (from get_unwhitened_templates, same as written to clus_Table.npy)
     clusterIDs : all unique cluster ids
     cluster_quality : 'noise' or 'good'
     sample_rate : Hz
     site_spacing : um (now unused)
-    w_inv : inverse of the whitening matrix used in KS2
     site_x, site_y: x and y coordinates of all channels, in um
 
     Outputs:
@@ -78,7 +79,7 @@ def metrics_from_file(mean_waveform_fullpath,
 
     # #############################################
 
-    metrics = pd.DataFrame()
+    unit_metrics_list = []
 
     cluster_ids = np.arange(np.max(spike_clusters) + 1)
     total_units = len(cluster_ids)
@@ -88,18 +89,10 @@ def metrics_from_file(mean_waveform_fullpath,
 
     channel_map = np.squeeze(channel_map)
     
-    nTemplate = templates.shape[0]
-    
-    # initialize peak_channels array
-    peak_channels = np.zeros([nTemplate,],'uint32')
-    # for each template (nt x nchan), multiply the the transpose (nchan x nt) by inverse of 
-    # the whitening matrix (nchan x nchan); get max and min along tthe time axis (1)
-    # to find the peak channel
-    for i in np.arange(0,nTemplate):
-        currT = templates[i,:].T
-        curr_unwh = np.matmul(w_inv, currT)
-        currdiff = np.max(curr_unwh,1) - np.min(curr_unwh,1)
-        peak_channels[i] = channel_map[np.argmax(currdiff)]
+    peak_channels = channel_map[peak_channel_idx].astype('uint32')
+
+    # site distances are computed once for all units
+    channel_neighbors = ChannelNeighbors(np.stack((site_x, site_y), 1))
     
     for cluster_idx, cluster_id in enumerate(cluster_ids):
 
@@ -107,9 +100,9 @@ def metrics_from_file(mean_waveform_fullpath,
 
         snr = snr_array[cluster_idx,0]
         nSpike = snr_array[cluster_idx,1]
-        # if at least one spike, calculate metrics and concatenate to existing dataframe
+        # if at least one spike, calculate metrics (concatenated once at the end)
         if nSpike > 0:
-            metrics = pd.concat([metrics, calculate_waveform_metrics_from_avg(mean_waveforms[cluster_idx,:],
+            unit_metrics_list.append(calculate_waveform_metrics_from_avg(mean_waveforms[cluster_idx,:],
                                                                      snr,
                                                                      cluster_id, 
                                                                      peak_channels[cluster_idx], 
@@ -118,10 +111,11 @@ def metrics_from_file(mean_waveform_fullpath,
                                                                      upsampling_factor,
                                                                      spread_threshold,
                                                                      site_range,
-                                                                     site_x, site_y                                                                    
-                                                                     )])
-
+                                                                     site_x, site_y,
+                                                                     channel_neighbors
+                                                                     ))
 
+    metrics = pd.concat(unit_metrics_list) if unit_metrics_list else pd.DataFrame()
 
     return metrics
 
@@ -1,6 +1,7 @@
 import numpy as np
 import random
 import pandas as pd
+import warnings
 
 from scipy.stats import linregress
 from scipy.signal import resample
@@ -53,12 +54,78 @@ def calculate_waveform_metrics(waveforms,
 
     """
 
-    snr = calculate_snr(waveforms[:, peak_channel, :])
+    with warnings.catch_warnings():
+
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        mean_waveform = np.nanmean(waveforms, 0)
+        std_waveform = np.nanstd(waveforms, 0)
+
+    return calculate_waveform_metrics_from_stats(mean_waveform,
+                                                 std_waveform,
+                                                 cluster_id, 
+                                                 peak_channel, 
+                                                 channel_map, 
+                                                 sample_rate, 
+                                                 upsampling_factor, 
+                                                 spread_threshold,
+                                                 site_range,
+                                                 site_spacing,
+                                                 epoch_name)
+
+
+def calculate_waveform_metrics_from_stats(mean_waveform,
+                                          std_waveform,
+                                          cluster_id, 
+                                          peak_channel, 
+                                          channel_map, 
+                                          sample_rate, 
+                                          upsampling_factor, 
+                                          spread_threshold,
+                                          site_range,
+                                          site_spacing,
+                                          epoch_name):
+    
+    """
+    Calculate waveform metrics from the mean and standard deviation of 
+    a unit's waveforms, so the individual spikes do not need to be kept 
+    in memory (see WaveformAccumulator in extract_waveforms).
+
+    Inputs:
+    -------
+    mean_waveform : numpy.ndarray (num_channels x num_samples)
+        Mean across spikes, before offset removal
+    std_waveform : numpy.ndarray (num_channels x num_samples)
+        Standard deviation across spikes (ddof = 0)
+    cluster_id : int
+        ID for cluster
+    peak_channel : int
+        Location of waveform peak
+    channel_map : numpy.ndarray
+        Channels used for spike sorting
+    sample_rate : float
+        Sample rate in Hz
+    upsampling_factor : float
+        Relative rate at which to upsample the spike waveform
+    spread_threshold : float
+        Threshold for computing spread of 2D waveform
+    site_range : float
+        Number of sites to use for 2D waveform metrics
+    site_spacing : float
+        Average vertical distance between sites (m)
+
+    Outputs:
+    -------
+    metrics : pandas.DataFrame
+        Single-row table containing all metrics
+
+    """
+
+    snr = calculate_snr_from_stats(mean_waveform[peak_channel, :], std_waveform[peak_channel, :])
 
-    mean_2D_waveform = np.squeeze(np.nanmean(waveforms[:, channel_map, :], 0))
+    mean_2D_waveform = np.squeeze(mean_waveform[channel_map, :])
     local_peak = np.argmin(np.abs(channel_map - peak_channel))
 
-    num_samples = waveforms.shape[2]
+    num_samples = mean_waveform.shape[1]
     new_sample_count = int(num_samples * upsampling_factor)
 
     mean_1D_waveform = resample(
@@ -96,7 +163,8 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
                                         upsampling_factor, 
                                         spread_threshold,
                                         site_range,
-                                        site_x, site_y):
+                                        site_x, site_y,
+                                        channel_neighbors = None):
 
     """
     Calculate metrics for an array of waveforms for a single cluster.
@@ -127,6 +195,8 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
     site_range : float
         Number of sites to use for 2D waveform metrics
     site_x, site_y : channel positions in um
+    channel_neighbors : ChannelNeighbors for site_x, site_y (optional)
+        Shared spatial index, to avoid recomputing site distances per unit
 
     Outputs:
     -------
@@ -165,7 +235,7 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
         mean_1D_waveform, timestamps)
 
     amplitude, spread, velocity_above, velocity_below = calculate_2D_features(
-        mean_2D_waveform, timestamps, local_peak, site_x, site_y, spread_threshold, site_range)
+        mean_2D_waveform, timestamps, local_peak, site_x, site_y, spread_threshold, site_range, channel_neighbors)
 
     data = [[cluster_id, epoch_name, peak_channel, snr, duration, halfwidth, PT_ratio, repolarization_slope,
               recovery_slope, amplitude, spread, velocity_above, velocity_below]]
@@ -210,6 +280,30 @@ def calculate_snr(W):
     return snr
 
 
+def calculate_snr_from_stats(W_bar, W_std):
+
+    """
+    Calculate SNR of spike waveforms from their mean and standard deviation.
+
+    Equivalent to calculate_snr, since every sample has the same number 
+    of spikes the residual variance is the mean of the per-sample variances.
+
+    Input:
+    -------
+    W_bar : mean waveform (samples)
+    W_std : standard deviation across waveforms (samples)
+
+    Output:
+    snr : signal-to-noise ratio for unit (scalar)
+
+    """
+
+    A = np.max(W_bar) - np.min(W_bar)
+    snr = A/(2*np.sqrt(np.mean(np.square(W_std))))
+
+    return snr
+
+
 def calculate_waveform_duration(waveform, timestamps):
     
     """ 
@@ -368,7 +462,7 @@ def calculate_waveform_recovery_slope(waveform, timestamps, window=20):
 # ==========================================================
 
 
-def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, spread_threshold = 0.12, site_range=16):
+def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, spread_threshold = 0.12, site_range=16, channel_neighbors = None):
     
     """ 
     Compute features of 2D waveform (channels x samples)
@@ -381,6 +475,7 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
     spread_threshold : float
     site_range: int
     site_x, site_y : float
+    channel_neighbors : ChannelNeighbors for site_x, site_y (optional)
 
     Outputs:
     --------
@@ -398,7 +493,13 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
     # x = x_peak or x_nn. For NP 1.0, this will select either the 
     # two left or two right hand columns.
     
-    dist = np.sqrt(( pow((site_x - site_x[peak_channel]),2) + pow((site_y - site_y[peak_channel]),2)))
+    if channel_neighbors is not None:
+        dist = channel_neighbors.distances_from(peak_channel)
+        sort_dist_ind = channel_neighbors.sorted_by_distance(peak_channel)
+    else:
+        dist = np.sqrt(( pow((site_x - site_x[peak_channel]),2) + pow((site_y - site_y[peak_channel]),2)))
+        sort_dist_ind = np.argsort(dist)
+
     ydiff = ( site_y != site_y[peak_channel])
     n_channel = site_x.size
     min_dist = 1e6   # a value larger than the  distance to nn
@@ -417,7 +518,6 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
             
     # select among sites with x = x_peak and x_nn for sites to sample
     inCol = (site_x == x_peak) | (site_x == x_nn)   
-    sort_dist_ind = np.argsort(dist)
     sites_to_sample = np.zeros(site_range+1, dtype='int32')
     
     nfound = 0
@@ -8,11 +8,27 @@ import numpy as np
 
 from ...common.utils import read_probe_json, get_repo_commit_date_and_hash
 
+from .median_subtraction import median_subtract_file
+
+MEDIAN_SUBTRACTION_ENGINES = ('numpy', 'executable')
+
 def run_median_subtraction(args):
 
     print('ecephys spike sorting: median subtraction module')
 
-    commit_date, commit_hash = get_repo_commit_date_and_hash(args['median_subtraction_params']['median_subtraction_repo'])
+    params = args['median_subtraction_params']
+
+    engine = params.get('engine', 'numpy')
+
+    if engine not in MEDIAN_SUBTRACTION_ENGINES:
+        raise ValueError('Unknown median subtraction engine ' + repr(engine) + '; expected one of ' + repr(MEDIAN_SUBTRACTION_ENGINES))
+
+    if engine == 'executable':
+        commit_date, commit_hash = get_repo_commit_date_and_hash(params['median_subtraction_repo'])
+    else:
+        # the engine is part of this package, so report the package's repository
+        commit_date, commit_hash = get_repo_commit_date_and_hash(os.path.dirname(os.path.abspath(__file__)),
+                                                                 search_parent_directories=True)
 
     mask, offset, scaling, surface_channel, air_channel = read_probe_json(args['common_files']['probe_json'])
 
@@ -20,10 +36,26 @@ def run_median_subtraction(args):
 
     start = time.time()
 
-    subprocess.check_call([args['median_subtraction_params']['median_subtraction_executable'], 
-                           args['common_files']['probe_json'],
-                           args['ephys_params']['ap_band_file'],
-                           str(int(air_channel))])
+    # the executable always overwrites the AP band file
+    output_file = args['ephys_params']['ap_band_file']
+
+    if engine == 'executable':
+
+        subprocess.check_call([params['median_subtraction_executable'], 
+                               args['common_files']['probe_json'],
+                               args['ephys_params']['ap_band_file'],
+                               str(int(air_channel))])
+
+    else:
+
+        output_file = params.get('output_file', None) or output_file
+
+        median_subtract_file(args['ephys_params']['ap_band_file'],
+                             args['ephys_params']['num_channels'],
+                             offset, scaling, mask, air_channel,
+                             output_file = output_file,
+                             chunk_samples = params.get('chunk_samples', 65536),
+                             num_workers = params.get('multiprocessing_worker_count', 1))
 
     execution_time = time.time() - start
 
@@ -32,7 +64,8 @@ def run_median_subtraction(args):
 
     return {"median_subtraction_execution_time" : execution_time,
             "median_subtraction_commit_date" : commit_date,
-            "median_subtraction_commit_hash" : commit_hash } # output manifest} # output manifest
+            "median_subtraction_commit_hash" : commit_hash,
+            "median_subtracted_file" : output_file } # output manifest
 
 def main():
 
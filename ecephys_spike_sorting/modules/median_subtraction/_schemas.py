@@ -4,8 +4,12 @@ from argschema.fields import Nested, InputDir, String, Float, Dict, Int
 from ...common.schemas import EphysParams, Directories, CommonFiles
 
 class MedianSubtractionParams(ArgSchema):
+    engine = String(required=False, default='numpy', help="'numpy' (streaming Python implementation) or 'executable' (compiled SpikeBandMedianSubtraction)")
     median_subtraction_executable = String(help='Path to .exe used for median subtraction (Windows only)')
     median_subtraction_repo = String(help='Path to local repository for median subtraction executable')
+    output_file = String(required=False, help="File for the median-subtracted data ('numpy' engine only); if omitted, the AP band file is overwritten in place. Later modules read ephys_params.ap_band_file, so point it at this file to use the median-subtracted data (the path is also returned as median_subtracted_file)")
+    chunk_samples = Int(required=False, default=65536, help="Samples per chunk read into memory ('numpy' engine only)")
+    multiprocessing_worker_count = Int(required=False, default=1, help="Number of worker processes, each handling one chunk at a time ('numpy' engine only)")
 
 class InputParameters(ArgSchema): 
 
@@ -24,4 +28,5 @@ class OutputParameters(OutputSchema):
     median_subtraction_execution_time = Float()
     median_subtraction_commit_hash = String()
     median_subtraction_commit_date = String()
+    median_subtracted_file = String()
     
\ No newline at end of file
@@ -0,0 +1,233 @@
+import os
+import shutil
+import multiprocessing
+
+import numpy as np
+
+from ...common.utils import printProgressBar
+
+
+def subtract_median(data, offset, scaling, mask, air_channel, channel_stride = 24):
+
+    """
+    Removes the DC offset and common-mode noise from a block of AP band samples
+
+    Same operations as the SpikeBandMedianSubtraction executable, applied to
+    every sample in the block at once:
+
+    1. the offset of each channel below air_channel is subtracted
+    2. channels are split into channel_stride groups (every 24th channel
+       shares an ADC), and the median of the masked channels in each group
+       is computed for every sample
+    3. each channel's group median, multiplied by its scaling factor and
+       truncated to an integer, is subtracted from that channel
+
+    Channels at or above air_channel are returned unchanged.
+
+    Inputs:
+    -------
+    data : numpy.ndarray (num_samples x num_channels)
+        int16 AP band data
+    offset : numpy.ndarray (num_channels x 0)
+        Offset of each channel from zero
+    scaling : numpy.ndarray (num_channels x 0)
+        Relative noise level on each channel
+    mask : numpy.ndarray (num_channels x 0)
+        1 if channel contains valid data, 0 otherwise
+    air_channel : Int
+        Index of channel at interface between saline/agar and air
+    channel_stride : Int
+        Number of channel groups (channels i, i + stride, ... share a median)
+
+    Outputs:
+    --------
+    output : numpy.ndarray (num_samples x num_channels)
+        int16 median-subtracted data
+    residuals : numpy.ndarray (num_samples x channel_stride)
+        int16 median subtracted from each channel group
+
+    """
+
+    num_channels = data.shape[1]
+    air_channel = int(np.min([air_channel, num_channels]))
+
+    output = np.array(data, dtype = 'int16')
+
+    # int16 arithmetic wraps, as in the executable
+    offset_subtracted = data[:, :air_channel] - np.asarray(offset[:air_channel]).astype('int16')
+
+    # channels of each group, padded to equal length with a column that is
+    # larger than any sample, so the padding never changes a lower median
+    groups = [np.arange(group, air_channel, channel_stride) for group in range(channel_stride)]
+    groups = [channels[np.asarray(mask)[channels] > 0] for channels in groups]
+
+    group_size = np.array([channels.size for channels in groups])
+    group_table = np.full((channel_stride, np.max([1, np.max(group_size)])), air_channel)
+
+    for group, channels in enumerate(groups):
+        group_table[group, :channels.size] = channels
+
+    padded = np.concatenate((offset_subtracted, np.full((data.shape[0], 1), np.iinfo('int16').max, dtype = 'int16')), 1)
+
+    # np.take and a 2-D sort are much faster here than fancy indexing and
+    # sorting along the last axis of a 3-D array
+    group_values = np.take(padded, group_table.ravel(), axis = 1)
+    group_values = np.sort(np.reshape(group_values, (-1, group_table.shape[1])), axis = 1)
+    group_values = np.reshape(group_values, (data.shape[0], channel_stride, group_table.shape[1]))
+
+    # lower median, so the residual is one of the channel values; groups
+    # with no valid channels have no common mode to estimate
+    median_idx = np.maximum(group_size - 1, 0) // 2
+    residuals = group_values[:, np.arange(channel_stride), median_idx]
+    residuals[:, group_size == 0] = 0
+
+    group_residuals = np.take(residuals, np.arange(air_channel) % channel_stride, axis = 1).astype('float32')
+    group_residuals *= np.asarray(scaling[:air_channel], dtype = 'float32')
+
+    output[:, :air_channel] = offset_subtracted - group_residuals.astype('int32').astype('int16')
+
+    return output, residuals
+
+
+def median_subtract_file(input_file, num_channels, offset, scaling, mask, air_channel,
+                         output_file = None,
+                         residuals_file = None,
+                         chunk_samples = 65536,
+                         num_workers = 1,
+                         channel_stride = 24):
+
+    """
+    Runs subtract_median over an int16 AP band file, one chunk at a time
+
+    Each sample is corrected independently, so the file is split into
+    non-overlapping chunks of chunk_samples, and only one chunk per worker
+    is held in memory. Chunks can be processed in parallel: each worker
+    opens its own memory maps and writes a separate range of the output.
+
+    Inputs:
+    -------
+    input_file : String
+        Path to int16 AP band file
+    num_channels : Int
+        Total number of channels in the file
+    offset, scaling, mask, air_channel :
+        Probe information (see read_probe_json and subtract_median)
+    output_file : String (optional)
+        Path for the median-subtracted data; if None or the same as
+        input_file, the input file is overwritten in place
+    residuals_file : String (optional)
+        Path for the subtracted medians (num_samples x channel_stride int16);
+        defaults to residuals.dat next to the output file
+    chunk_samples : Int
+        Samples per chunk
+    num_workers : Int
+        Number of worker processes (1 = serial)
+    channel_stride : Int
+        See subtract_median
+
+    Outputs:
+    --------
+    residuals_file : String
+        Path of the residuals file
+
+    """
+
+    if output_file is None:
+        output_file = input_file
+
+    if residuals_file is None:
+        residuals_file = os.path.join(os.path.dirname(os.path.abspath(output_file)), 'residuals.dat')
+
+    total_bytes = os.path.getsize(input_file)
+    num_samples = total_bytes // (2 * num_channels)
+
+    # the new file starts as a copy, so anything outside complete samples is kept
+    if os.path.abspath(output_file) != os.path.abspath(input_file):
+        with open(input_file, 'rb') as source, open(output_file, 'wb') as destination:
+            source.seek(num_samples * num_channels * 2)
+            destination.truncate(num_samples * num_channels * 2)
+            destination.seek(num_samples * num_channels * 2)
+            shutil.copyfileobj(source, destination)
+
+    with open(residuals_file, 'wb') as f:
+        f.truncate(num_samples * channel_stride * 2)
+
+    settings = {'input_file' : input_file,
+                'output_file' : output_file,
+                'residuals_file' : residuals_file,
+                'num_channels' : num_channels,
+                'num_samples' : num_samples,
+                'offset' : np.asarray(offset),
+                'scaling' : np.asarray(scaling),
+                'mask' : np.asarray(mask),
+                'air_channel' : air_channel,
+                'channel_stride' : channel_stride}
+
+    chunk_starts = np.arange(0, num_samples, chunk_samples)
+    chunks = [(start, int(np.min([start + chunk_samples, num_samples]))) for start in chunk_starts]
+
+    num_workers = int(np.max([1, np.min([num_workers, multiprocessing.cpu_count(), len(chunks)])]))
+
+    if num_workers > 1:
+
+        with multiprocessing.Pool(num_workers,
+                                  initializer = init_median_worker,
+                                  initargs = (settings,)) as pool:
+
+            for idx, chunk in enumerate(pool.imap(median_chunk_worker, chunks)):
+                printProgressBar(idx + 1, len(chunks))
+
+    else:
+
+        init_median_worker(settings)
+
+        for idx, chunk in enumerate(chunks):
+            median_chunk_worker(chunk)
+            printProgressBar(idx + 1, len(chunks))
+
+        _median_worker_data.clear()
+
+    return residuals_file
+
+
+_median_worker_data = {}
+
+def init_median_worker(settings):
+
+    # every worker opens its own memory maps of the data and residuals files
+    shape = (settings['num_samples'], settings['num_channels'])
+
+    in_place = os.path.abspath(settings['output_file']) == os.path.abspath(settings['input_file'])
+
+    if shape[0] > 0:
+        output = np.memmap(settings['output_file'], dtype = 'int16', mode = 'r+', shape = shape)
+        data = output if in_place else np.memmap(settings['input_file'], dtype = 'int16', mode = 'r', shape = shape)
+        residuals = np.memmap(settings['residuals_file'], dtype = 'int16', mode = 'r+',
+                              shape = (shape[0], settings['channel_stride']))
+    else:
+        output = data = residuals = None
+
+    _median_worker_data.update({'data' : data, 'output' : output, 'residuals' : residuals, 'settings' : settings})
+
+
+def median_chunk_worker(chunk):
+
+    """ Median-subtracts samples chunk[0] to chunk[1] (see median_subtract_file) """
+
+    start, end = chunk
+    settings = _median_worker_data['settings']
+
+    output, residuals = subtract_median(np.array(_median_worker_data['data'][start:end, :]),
+                                        settings['offset'],
+                                        settings['scaling'],
+                                        settings['mask'],
+                                        settings['air_channel'],
+                                        settings['channel_stride'])
+
+    _median_worker_data['output'][start:end, :] = output
+    _median_worker_data['residuals'][start:end, :] = residuals
+
+    _median_worker_data['output'].flush()
+    _median_worker_data['residuals'].flush()
+
+    return chunk
@@ -28,7 +28,7 @@ class NoiseWaveformParams(DefaultSchema):
     min_wavelet_peak_loc = Int(default=15, help='Minimum wavelet peak location for good units')
     max_wavelet_peak_loc = Int(default=25, help='Maximum wavelet peak location for good units')
 
-    multiprocessing_worker_count = Int(default=4, help='Number of workers to use for spatial peak calculation')
+    multiprocessing_worker_count = Int(default=4, help='Number of workers to use for spread, shape and spatial peak checks')
     use_random_forest = Boolean(default=False, help='set to false to use heuristic  noise id')
 
 class InputParameters(ArgSchema):
@@ -3,13 +3,13 @@ import numpy as np
 from scipy.signal import correlate, find_peaks, cwt, ricker
 from sklearn.ensemble import RandomForestClassifier
 
-from scipy.interpolate import griddata
+from scipy.interpolate import CloughTocher2DInterpolator
+from scipy.spatial import Delaunay
 from scipy.ndimage.filters import gaussian_filter1d
 
 from ...common.utils import printProgressBar
 
 import multiprocessing
-from functools import partial
 
 import pickle
 
@@ -94,8 +94,13 @@ def id_noise_templates(cluster_ids, templates, channel_map, params):
 
     is_noise = np.zeros((templates.shape[0],),dtype='bool')
 
+    # spread (with shape) and spatial peaks are checked in a single pass
+    # over all templates
+    spread_noise, spatial_peaks_noise = check_templates(templates, channel_map, params,
+                                                        checks = ('spread', 'spatial_peaks')).T
+
     print('Checking spread...')
-    is_noise += check_template_spread(templates, channel_map, params)
+    is_noise += spread_noise
     print(' Total noise templates: ' + str(np.sum(is_noise)))
     #print(cluster_ids[np.where(is_noise)[0]])
 
@@ -105,13 +110,80 @@ def id_noise_templates(cluster_ids, templates, channel_map, params):
     #print(cluster_ids[np.where(is_noise)[0]])
 
     print('Checking spatial peaks...')
-    is_noise += check_template_spatial_peaks(templates, channel_map, params)
+    is_noise += spatial_peaks_noise
     print(' Total noise templates: ' + str(np.sum(is_noise)))
     #print(cluster_ids[np.where(is_noise)[0]])
 
     return cluster_ids, is_noise[cluster_ids]
     
 
+def check_templates(templates, channel_map, params, checks = ('spread', 'spatial_peaks')):
+
+    """
+    Runs per-template noise checks for all templates
+
+    Templates are handled by a single pool of params['multiprocessing_worker_count']
+    workers, each of which receives the templates and the interpolation grid
+    once, when it starts, rather than with every task.
+
+    Inputs:
+    -------
+    templates : template for each unit output by Kilosort
+    channel_map : mapping between template channels and actual probe channels
+    checks : names of checks to run (keys of TEMPLATE_CHECKS)
+
+    Outputs:
+    -------
+    is_noise : boolean array (templates x checks), True where a template fails a check
+
+    """
+
+    num_workers = int(np.max([1, np.min([params.get('multiprocessing_worker_count', 1),
+                                         multiprocessing.cpu_count(),
+                                         templates.shape[0]])]))
+
+    worker_args = (templates, channel_map, params, checks)
+
+    if num_workers > 1:
+
+        with multiprocessing.Pool(num_workers,
+                                  initializer = init_template_checks_worker,
+                                  initargs = worker_args) as pool:
+            is_noise = pool.map(template_checks_worker, np.arange(templates.shape[0]))
+
+    else:
+
+        init_template_checks_worker(*worker_args)
+        is_noise = [template_checks_worker(index) for index in np.arange(templates.shape[0])]
+        _template_checks_data.clear()
+
+    return np.array(is_noise, dtype = 'bool').reshape((templates.shape[0], len(checks)))
+
+
+_template_checks_data = {}
+
+def init_template_checks_worker(templates, channel_map, params, checks):
+
+    _template_checks_data.update({'templates' : templates,
+                                  'channel_map' : channel_map,
+                                  'params' : params,
+                                  'checks' : checks,
+                                  'grid' : get_interpolation_grid(channel_map)})
+
+
+def template_checks_worker(index):
+
+    """ Runs the checks set by init_template_checks_worker on one template """
+
+    template = _template_checks_data['templates'][index,:,:]
+
+    return [TEMPLATE_CHECKS[check](template,
+                                   _template_checks_data['channel_map'],
+                                   _template_checks_data['params'],
+                                   _template_checks_data['grid'])
+            for check in _template_checks_data['checks']]
+
+
 def check_template_spread(templates, channel_map, params):
 
     """
@@ -130,24 +202,24 @@ def check_template_spread(templates, channel_map, params):
     ----------
     """
 
-    is_noise = []
+    return check_templates(templates, channel_map, params, checks = ('spread',))[:,0]
 
-    for i in range(templates.shape[0]):
-        MM = np.max(np.abs(templates[i,:,:]),0)
-        MM = MM / np.max(MM)
-        MMF = gaussian_filter1d(MM, params['smoothed_template_filter_width'])
 
-        spread1 = np.sum(MMF > params['smoothed_template_amplitude_threshold'])
-        spread2 = np.sum(MM > params['template_amplitude_threshold'])
+def template_spread(template, channel_map, params, grid = None):
 
-        if (spread1 <= params['mid_spread_threshold']):
-            is_noise.append(spread2 < params['min_spread_threshold'])
-        elif spread1 > params['mid_spread_threshold'] and spread1 <= params['max_spread_threshold']:
-            is_noise.append(check_template_shape(templates[i,:,:], params))
-        else:
-            is_noise.append(True)
+    MM = np.max(np.abs(template),0)
+    MM = MM / np.max(MM)
+    MMF = gaussian_filter1d(MM, params['smoothed_template_filter_width'])
+
+    spread1 = np.sum(MMF > params['smoothed_template_amplitude_threshold'])
+    spread2 = np.sum(MM > params['template_amplitude_threshold'])
 
-    return np.array(is_noise)
+    if (spread1 <= params['mid_spread_threshold']):
+        return spread2 < params['min_spread_threshold']
+    elif spread1 > params['mid_spread_threshold'] and spread1 <= params['max_spread_threshold']:
+        return check_template_shape(template, params)
+    else:
+        return True
 
 
 def check_template_spatial_peaks(templates, channel_map, params):
@@ -168,25 +240,18 @@ def check_template_spatial_peaks(templates, channel_map, params):
     ----------
     """
 
-    is_noise = []
-
-    pool = multiprocessing.Pool(np.min([params['multiprocessing_worker_count'],multiprocessing.cpu_count()]))
-    is_noise = pool.map(partial(template_spatial_peaks, templates, channel_map, params), 
-                        np.arange(templates.shape[0]))
+    return check_templates(templates, channel_map, params, checks = ('spatial_peaks',))[:,0]
 
-    return np.array(is_noise)
 
+def template_spatial_peaks(template, channel_map, params, grid = None):
 
-def template_spatial_peaks(templates, channel_map, params, index):
-
-    template = templates[index,:,:]
-        
     peak_channel = np.argmax((np.max(template,0) - np.min(template,0)))
     peak_index = np.argmax((np.max(template,1) - np.min(template,1)))
 
-    temp = interpolate_template(template, channel_map)
+    # only the peak sample is needed
+    temp = interpolate_template(template[peak_index:peak_index+1,:], channel_map, grid)
     
-    peak_waveform = temp[peak_index,:,1:6]
+    peak_waveform = temp[0,:,1:6]
     pw = peak_waveform.flatten()
     si = np.sign(pw[np.argmax(np.abs(pw))])
 
@@ -205,6 +270,10 @@ def template_spatial_peaks(templates, channel_map, params, index):
     return (np.std(peak_locs) > params['peak_locs_std_thresh'])
 
 
+TEMPLATE_CHECKS = {'spread' : template_spread,
+                   'spatial_peaks' : template_spatial_peaks}
+
+
 def check_template_temporal_peaks(templates, channel_map, params):
 
     """
@@ -336,34 +405,58 @@ def interp_channel_locations(channel_map):
 
     return interp_channel_locations
 
-def interpolate_template(template, channel_map):
+def get_interpolation_grid(channel_map):
 
     """
-    Interpolate template, based on physical channel locations
+    Triangulation of the actual channel locations and the virtual channel grid
+
+    Both depend only on the channel map, so they can be computed once and
+    passed to interpolate_template for every template.
 
     Inputs:
     -------
-    template : template for one unit (samples x channels)
     channel_map : mapping between template channels and actual probe channels
 
     Outputs:
     --------
-    template_interp : 3D interpolated template (samples x height x width)
+    grid : dict
+        - triangulation : Delaunay triangulation of actual_channel_locations
+        - locations : interp_channel_locations
+        - shape : (height, width) of the virtual channel grid
     
     """
 
-    total_samples = template.shape[0]
     loc_a = actual_channel_locations(channel_map)
     loc_i = interp_channel_locations(channel_map)
+
+    return {'triangulation' : Delaunay(loc_a),
+            'locations' : loc_i,
+            'shape' : (len(np.unique(loc_i[:,1])), len(np.unique(loc_i[:,0])))}
+
+def interpolate_template(template, channel_map, grid = None):
+
+    """
+    Interpolate template, based on physical channel locations
+
+    Inputs:
+    -------
+    template : template for one unit (samples x channels)
+    channel_map : mapping between template channels and actual probe channels
+    grid : output of get_interpolation_grid (optional, computed if not given)
+
+    Outputs:
+    --------
+    template_interp : 3D interpolated template (samples x height x width)
     
-    x_i = np.unique(loc_i[:,0])
-    y_i = np.unique(loc_i[:,1])
-    
-    interp_temp = np.zeros((total_samples, len(x_i) * len(y_i)))
-    
-    for t in range(0,total_samples):
+    """
 
-        interp_temp[t,:,] = griddata(loc_a, template[t,:], loc_i, method='cubic', fill_value=0, rescale=False)  
+    if grid is None:
+        grid = get_interpolation_grid(channel_map)
+
+    total_samples = template.shape[0]
 
-    return np.reshape(interp_temp, (total_samples, len(y_i), len(x_i))).astype('float')       
+    # same cubic interpolation as griddata, for all samples at once
+    interpolator = CloughTocher2DInterpolator(grid['triangulation'], template.T, fill_value=0)
+    interp_temp = interpolator(grid['locations']).T
 
+    return np.reshape(interp_temp, (total_samples,) + grid['shape']).astype('float')
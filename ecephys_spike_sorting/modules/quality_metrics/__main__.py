@@ -7,10 +7,12 @@ import time
 import numpy as np
 import pandas as pd
 
-from ...common.utils import load_kilosort_data
+from ...common.utils import KilosortData
 from ...common.epoch import get_epochs_from_nwb_file
+from ...common.metrics_table import read_metrics, write_metrics, merge_metrics, get_metrics_format
 
 from .metrics import calculate_metrics
+from .metrics_cache import MetricsCache, get_cache_file
 
 
 def calculate_quality_metrics(args):
@@ -21,28 +23,30 @@ def calculate_quality_metrics(args):
     
     include_pcs = args['quality_metrics_params']['include_pcs']
 
+    output_file = args['cluster_metrics']['cluster_metrics_file']
+
+    if args['quality_metrics_params'].get('incremental', False) and include_pcs:
+        metrics_cache = MetricsCache(get_cache_file(output_file))
+    else:
+        metrics_cache = None
+
     print("Loading data...")
 
     try:
-        if include_pcs:
-            spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-            channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                    load_kilosort_data(args['directories']['kilosort_output_directory'], \
+        # pc_features is memory-mapped; only the spikes in each epoch are read
+        data = KilosortData(args['directories']['kilosort_output_directory'], \
                         args['ephys_params']['sample_rate'], \
-                        use_master_clock = False,
-                        include_pcs = include_pcs)
+                        use_master_clock = False)
+
+        if include_pcs:
+            pc_features = data.pc_features
+            pc_feature_ind = data.pc_feature_ind
         else:
-            spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-            channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
-            load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                        args['ephys_params']['sample_rate'], \
-                        use_master_clock = False,
-                        include_pcs = include_pcs)
             pc_features = []
             pc_feature_ind = []
             
 
-        metrics = calculate_metrics(spike_times, spike_clusters, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, args['quality_metrics_params'])
+        metrics = calculate_metrics(data.spike_times, data.spike_clusters, data.amplitudes, data.channel_map, data.channel_pos, data.templates, pc_features, pc_feature_ind, args['quality_metrics_params'], metrics_cache = metrics_cache)
 
     except FileNotFoundError:
         
@@ -53,18 +57,18 @@ def calculate_quality_metrics(args):
         return {"execution_time" : execution_time,
             "quality_metrics_output_file" : None} 
 
-    
-    output_file = args['cluster_metrics']['cluster_metrics_file']
 
     if os.path.exists(args['waveform_metrics']['waveform_metrics_file']):
-        metrics = metrics.merge(pd.read_csv(args['waveform_metrics']['waveform_metrics_file'], index_col=0),
-                     on='cluster_id',
-                     suffixes=('_quality_metrics','_waveform_metrics'))
+        metrics = merge_metrics(metrics, read_metrics(args['waveform_metrics']['waveform_metrics_file']),
+                     columnar = get_metrics_format(output_file) != 'csv')
 
     print("Saving data...")
    
 
-    metrics.to_csv(output_file)
+    write_metrics(metrics, output_file)
+
+    if metrics_cache is not None:
+        metrics_cache.save()
 
     execution_time = time.time() - start
 
@@ -11,11 +11,14 @@ class QualityMetricsParams(DefaultSchema):
     max_spikes_for_unit = Int(required=False, default=500, help='Number of spikes to subsample for computing PC metrics')
     max_spikes_for_nn = Int(required=False, default=10000, help='Further subsampling for NearestNeighbor calculation')
     n_neighbors = Int(required=False, default=4, help='Number of neighbors to use for NearestNeighbor calculation')
+    nn_backend = String(required=False, default='exact', help="Nearest neighbor search for nn_hit_rate and nn_miss_rate: 'exact' (ball tree) or 'random_projection' (approximate, faster for many spikes; rates within ~0.01 of exact)")
     n_silhouette = Int(required=False, default=10000, help='Number of spikes to use for calculating silhouette score')
 
     drift_metrics_min_spikes_per_interval = Int(required=False, default=10, help='Minimum number of spikes for computing depth')
     drift_metrics_interval_s = Float(required=False, default=100, help='Interval length is seconds for computing spike depth')
     include_pcs = Boolean(required=False, default=True, help='Set to false if features were not saved with Phy output')
+    multiprocessing_worker_count = Int(required=False, default=1, help='Number of worker processes for computing PC metrics (1 = serial)')
+    incremental = Boolean(required=False, default=False, help='Keep PC metrics in a cache file next to the metrics file (metrics_cache.csv) and only recompute units whose spikes, or whose neighbors\' spikes, have changed since the last run')
 
 class InputParameters(ArgSchema):
     
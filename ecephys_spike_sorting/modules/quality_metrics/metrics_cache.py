@@ -0,0 +1,116 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+PC_METRICS = ('isolation_distance', 'l_ratio', 'd_prime', 'nn_hit_rate', 'nn_miss_rate')
+
+
+class MetricsCache():
+
+    """
+    Per-unit PC metrics from a previous run, keyed by a hash of their inputs
+
+    Each row holds the metrics for one (epoch_name, cluster_id), the hash of
+    everything those metrics were computed from (see pc_metrics_input_keys),
+    and the seed used for subsampling in that epoch. A unit whose hash still
+    matches is read from the cache instead of being recomputed.
+
+    Only the rows used or added since loading are written back by save(), so
+    clusters that no longer exist (e.g. after a merge) are dropped.
+
+    """
+
+    def __init__(self, filename):
+
+        """
+        filename : str
+            Location of the cache file (CSV); it is read if it exists
+        """
+
+        self.filename = filename
+
+        self._cached = {}
+        self._current = {}
+        self._base_seeds = {}
+
+        if os.path.exists(filename):
+            self.load()
+
+
+    def load(self):
+
+        table = pd.read_csv(self.filename, dtype = {'epoch_name' : str, 'input_hash' : str},
+                            float_precision = 'round_trip')
+
+        for row in table.itertuples(index = False):
+            self._cached[(row.epoch_name, row.cluster_id)] = \
+                (row.input_hash, tuple(getattr(row, metric) for metric in PC_METRICS))
+            self._base_seeds[row.epoch_name] = int(row.base_seed)
+
+
+    def base_seed(self, epoch_name, default):
+
+        """ Returns the subsampling seed stored for an epoch, or stores default """
+
+        return self._base_seeds.setdefault(epoch_name, int(default))
+
+
+    def get(self, epoch_name, cluster_id, input_hash):
+
+        """ Returns the cached metrics for one unit, or None if its inputs have changed
+
+        Input:
+        ------
+        epoch_name : str
+            Name of the epoch
+        cluster_id : int
+            ID for this unit
+        input_hash : str
+            Hash of the current inputs for this unit
+
+        Output:
+        -------
+        metrics : tuple or None
+            isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate
+
+        """
+
+        key = (epoch_name, cluster_id)
+
+        if key not in self._cached or self._cached[key][0] != input_hash:
+            return None
+
+        self._current[key] = self._cached[key]
+
+        return self._cached[key][1]
+
+
+    def put(self, epoch_name, cluster_id, input_hash, metrics):
+
+        """ Stores the metrics for one unit (see get) """
+
+        self._current[(epoch_name, cluster_id)] = (input_hash, tuple(metrics))
+
+
+    def save(self):
+
+        keys = sorted(self._current.keys())
+
+        columns = [('epoch_name', [key[0] for key in keys]),
+                   ('cluster_id', [key[1] for key in keys]),
+                   ('input_hash', [self._current[key][0] for key in keys]),
+                   ('base_seed', [self._base_seeds[key[0]] for key in keys])]
+
+        for idx, metric in enumerate(PC_METRICS):
+            columns.append((metric, np.array([self._current[key][1][idx] for key in keys], dtype = 'float64')))
+
+        pd.DataFrame(data = dict(columns), columns = [name for name, values in columns]).to_csv(self.filename, index = False)
+
+
+def get_cache_file(cluster_metrics_file):
+
+    """ Returns the cache location for a metrics file: metrics.csv -> metrics_cache.csv """
+
+    return os.path.splitext(cluster_metrics_file)[0] + '_cache.csv'
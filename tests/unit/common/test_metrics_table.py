@@ -0,0 +1,86 @@
+import sys
+
+import pytest
+import numpy as np
+import pandas as pd
+
+import ecephys_spike_sorting.common.metrics_table as metrics_table
+
+def make_metrics(epoch_name, cluster_ids, value):
+
+	return pd.DataFrame({'cluster_id' : cluster_ids,
+	                     'firing_rate' : np.ones((len(cluster_ids),)) * value,
+	                     'epoch_name' : [epoch_name] * len(cluster_ids)})
+
+@pytest.mark.parametrize('extension', ['.parquet', '.feather'])
+def test_write_metrics(tmp_path, extension):
+
+	pytest.importorskip('pyarrow')
+
+	filename = str(tmp_path / ('metrics' + extension))
+
+	metrics = pd.concat((make_metrics('session', [2, 0, 1], 1.0), make_metrics('epoch1', [0, 1], 2.0)))
+	metrics_table.write_metrics(metrics, filename)
+
+	metrics = metrics_table.read_metrics(filename)
+
+	assert(list(metrics.columns) == ['cluster_id', 'epoch_name', 'firing_rate'])
+	assert(metrics['cluster_id'].dtype == np.int64)
+	assert(list(zip(metrics['cluster_id'], metrics['epoch_name'], metrics['firing_rate'])) == \
+	       [(0, 'epoch1', 2.0), (0, 'session', 1.0), (1, 'epoch1', 2.0), (1, 'session', 1.0), (2, 'session', 1.0)])
+
+@pytest.mark.parametrize('extension', ['.parquet', '.feather'])
+def test_columnar_metrics_without_pyarrow(tmp_path, extension, monkeypatch):
+
+	# behave as if pyarrow were not installed
+	monkeypatch.setitem(sys.modules, 'pyarrow', None)
+
+	filename = str(tmp_path / ('metrics' + extension))
+
+	with pytest.raises(ImportError, match=extension[1:]):
+		metrics_table.write_metrics(make_metrics('session', [0, 1], 1.0), filename)
+
+	with pytest.raises(ImportError, match=extension[1:]):
+		metrics_table.read_metrics(filename)
+
+	metrics_table.write_metrics(make_metrics('session', [0, 1], 1.0), str(tmp_path / 'metrics.csv'))
+
+def test_merge_metrics():
+
+	cluster_metrics = make_metrics('session', [0, 1, 2], 1.0)
+	waveform_metrics = pd.DataFrame({'cluster_id' : [1, 0], 'epoch_name' : ['session'] * 2, 'snr' : [4.0, 5.0]})
+
+	merged = metrics_table.merge_metrics(cluster_metrics, waveform_metrics, columnar=True)
+
+	assert(np.array_equal(merged['snr'], [5.0, 4.0, np.nan], equal_nan=True))
+
+	# merging again replaces the waveform metrics instead of adding suffixed columns
+	merged = metrics_table.merge_metrics(merged, waveform_metrics.assign(snr=[6.0, 7.0]), columnar=True)
+
+	assert(list(merged.columns) == ['cluster_id', 'epoch_name', 'firing_rate', 'snr'])
+	assert(np.array_equal(merged['snr'], [7.0, 6.0, np.nan], equal_nan=True))
+
+@pytest.mark.parametrize('extension', ['.csv', '.parquet', '.feather'])
+def test_write_metrics_append(tmp_path, extension):
+
+	if extension != '.csv':
+		pytest.importorskip('pyarrow')
+
+	filename = str(tmp_path / ('metrics' + extension))
+
+	metrics_table.write_metrics(make_metrics('session', [0, 1, 2], 1.0), filename, append=True)
+	metrics_table.write_metrics(make_metrics('epoch1', [0, 1], 2.0), filename, append=True)
+
+	# rows with the same (cluster_id, epoch_name) are replaced, the others are kept
+	metrics_table.write_metrics(make_metrics('session', [1, 3], 3.0), filename, append=True)
+
+	metrics = metrics_table.read_metrics(filename)
+
+	rows = sorted(zip(metrics['cluster_id'], metrics['epoch_name'], metrics['firing_rate']))
+
+	assert(rows == [(0, 'epoch1', 2.0), (0, 'session', 1.0), (1, 'epoch1', 2.0), (1, 'session', 3.0),
+	                (2, 'session', 1.0), (3, 'session', 3.0)])
+
+	metrics_table.write_metrics(make_metrics('session', [0], 4.0), filename)
+
+	assert(len(metrics_table.read_metrics(filename)) == 1)
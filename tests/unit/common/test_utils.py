@@ -46,3 +46,31 @@ def test_find_range():
 	output = utils.find_range(data, 20, 30)
 
 	assert(np.array_equal(output, np.arange(20,31)))
+
+
+def test_get_unwhitened_templates(tmpdir):
+
+	rng = np.random.RandomState(0)
+
+	templates = rng.randn(5, 82, 16).astype('float32')
+	# Kilosort 2's local whitening gives a non-symmetric matrix
+	w_inv = rng.randn(16, 16)
+	assert(not np.allclose(w_inv, w_inv.T))
+
+	np.save(os.path.join(str(tmpdir), 'templates.npy'), templates)
+	np.save(os.path.join(str(tmpdir), 'whitening_mat_inv.npy'), w_inv)
+
+	unwhitened, peak_channel_idx, amplitudes = utils.get_unwhitened_templates(str(tmpdir))
+
+	for i in range(templates.shape[0]):
+		expected = np.matmul(w_inv, templates[i,:,:].T)
+		assert(np.allclose(unwhitened[i,:,:], expected.T))
+		assert(peak_channel_idx[i] == np.argmax(np.max(expected,1) - np.min(expected,1)))
+		assert(np.isclose(amplitudes[i], np.max(np.max(expected,1) - np.min(expected,1))))
+
+	assert(os.path.exists(os.path.join(str(tmpdir), 'templates_unwhitened.npy')))
+
+	cached, cached_peak_channel_idx, cached_amplitudes = utils.get_unwhitened_templates(str(tmpdir))
+
+	assert(np.array_equal(cached, unwhitened))
+	assert(np.array_equal(cached_amplitudes, amplitudes))
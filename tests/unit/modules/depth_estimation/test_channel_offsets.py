@@ -0,0 +1,58 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.modules.depth_estimation.depth_estimation import compute_channel_offsets
+from ecephys_spike_sorting.common.utils import rms
+
+def channel_offsets_per_channel(ap_data, ephys_params, params):
+
+	# one channel at a time, as compute_channel_offsets used to do
+	numChannels = ephys_params['num_channels']
+	offsets = np.zeros((numChannels, params['n_passes']), dtype='int16')
+	rms_noise = np.zeros((numChannels, params['n_passes']), dtype='float')
+
+	for i in range(params['n_passes']):
+		start_sample = int((params['start_time'] + params['skip_s_per_pass'] * i) * ephys_params['sample_rate'])
+		end_sample = start_sample + int(params['time_interval'] * ephys_params['sample_rate'])
+		for ch in range(numChannels):
+			data = ap_data[start_sample:end_sample, ch]
+			offsets[ch,i] = np.median(data)
+			rms_noise[ch,i] = rms(data - offsets[ch,i]) * ephys_params['bit_volts']
+
+	mask = np.ones((numChannels,), dtype=bool)
+	mask[ephys_params['reference_channels']] = False
+	mask[np.median(rms_noise,1) > params['hi_noise_thresh']] = False
+	mask[np.median(rms_noise,1) < params['lo_noise_thresh']] = False
+
+	return np.median(offsets,1).astype('int16'), mask
+
+@pytest.mark.parametrize('n_threads', [1, 2])
+def test_compute_channel_offsets(tmp_path, n_threads):
+
+	num_channels = 40
+	sample_rate = 2500.0
+
+	rng = np.random.RandomState(0)
+	noise_levels = rng.uniform(5, 60, num_channels)
+	noise_levels[[3, 17]] = [1, 400]   # below and above the noise thresholds
+
+	data = (rng.randn(int(sample_rate * 12), num_channels) * noise_levels + rng.randint(-500, 500, num_channels)).astype('int16')
+
+	raw_data_file = str(tmp_path / 'continuous.dat')
+	data.tofile(raw_data_file)
+	ap_data = np.memmap(raw_data_file, dtype='int16', mode='r').reshape((-1, num_channels))
+
+	ephys_params = {'num_channels' : num_channels, 'sample_rate' : sample_rate, 'bit_volts' : 0.195,
+	                'reference_channels' : np.array([10, 30])}
+
+	params = {'n_passes' : 3, 'start_time' : 0.5, 'skip_s_per_pass' : 3, 'time_interval' : 5,
+	          'hi_noise_thresh' : 10.0, 'lo_noise_thresh' : 3.0, 'n_threads' : n_threads}
+
+	output = compute_channel_offsets(ap_data, ephys_params, params)
+
+	offsets, mask = channel_offsets_per_channel(ap_data, ephys_params, params)
+
+	assert(np.array_equal(output['offsets'], offsets))
+	assert(np.array_equal(output['mask'], mask))
+	assert(not mask[3] and not mask[17] and not mask[10])
+	assert(np.sum(mask) > 3)
@@ -0,0 +1,95 @@
+import pytest
+import numpy as np
+
+from scipy.signal import welch
+from scipy.ndimage import gaussian_filter1d
+
+from ecephys_spike_sorting.modules.depth_estimation.depth_estimation import find_surface_channel, subtract_lfp_medians
+
+def subtract_lfp_medians_per_channel(chunk, channel_range):
+
+	# one channel at a time, as find_surface_channel used to do
+	chunk = np.copy(chunk)
+
+	for ch in np.arange(chunk.shape[1]):
+		chunk[:,ch] = chunk[:,ch] - np.median(chunk[:,ch])
+
+	for ch in np.arange(chunk.shape[1]):
+		chunk[:,ch] = chunk[:,ch] - np.median(chunk[:,channel_range[0]:channel_range[1]],1)
+
+	return chunk
+
+def surface_channel_per_channel(lfp_data, ephys_params, params, n_passes):
+
+	nchannels = ephys_params['num_channels']
+	candidates = np.zeros((n_passes,))
+
+	for p in range(n_passes):
+		startPt = int(ephys_params['lfp_sample_rate'] * params['skip_s_per_pass'] * p)
+		chunk = subtract_lfp_medians_per_channel(lfp_data[startPt:startPt + int(ephys_params['lfp_sample_rate']), :],
+		                                         params['channel_range'])
+
+		power = np.zeros((int(params['nfft']/2+1), nchannels))
+		for ch in np.arange(nchannels):
+			sample_frequencies, power[:,ch] = welch(chunk[:,ch], fs=ephys_params['lfp_sample_rate'], nfft=params['nfft'])
+
+		in_range_gamma = np.where((sample_frequencies >= params['freq_range'][0]) * (sample_frequencies <= params['freq_range'][1]))[0]
+		values = np.log10(np.mean(power[in_range_gamma,:],0))
+		values[ephys_params['reference_channels']] = values[ephys_params['reference_channels']-1]
+		values = gaussian_filter1d(values, params['smoothing_amount'])
+
+		surface_channels = np.where((np.diff(values) < params['diff_thresh']) * (values[:-1] < params['power_thresh']))[0]
+		candidates[p] = np.max(surface_channels) if len(surface_channels) > 0 else nchannels
+
+	return np.median(candidates)
+
+def make_lfp_data(num_channels, num_samples, surface_channel):
+
+	rng = np.random.RandomState(0)
+
+	# large low-frequency signals below the surface, small ones above it
+	slow = np.cumsum(rng.randn(num_samples, num_channels), 0)
+	slow -= np.mean(slow, 0)
+	amplitude = np.where(np.arange(num_channels) < surface_channel, 8.0, 0.3)
+
+	data = rng.randn(num_samples, num_channels) * 20 + rng.randint(-300, 300, num_channels) + slow * amplitude
+
+	return data.astype('int16')
+
+def test_subtract_lfp_medians():
+
+	chunk = make_lfp_data(96, 2500, 60)
+
+	for channel_range in [[86, 92], [0, 5], [90, 100]]:
+		assert(np.array_equal(subtract_lfp_medians(chunk, channel_range),
+		                      subtract_lfp_medians_per_channel(chunk, channel_range)))
+
+@pytest.mark.parametrize('n_threads', [1, 2])
+def test_find_surface_channel(n_threads):
+
+	num_channels = 96
+	lfp_sample_rate = 2500.0
+
+	lfp_data = make_lfp_data(num_channels, int(lfp_sample_rate * 12), 60)
+
+	ephys_params = {'num_channels' : num_channels, 'lfp_sample_rate' : lfp_sample_rate,
+	                'reorder_lfp_channels' : False, 'reference_channels' : np.array([37, 76])}
+
+	params = {'smoothing_amount' : 2, 'power_thresh' : 2.5, 'diff_thresh' : -0.07, 'freq_range' : [0, 10],
+	          'max_freq' : 150, 'channel_range' : [86, 92], 'n_passes' : 3, 'skip_s_per_pass' : 3,
+	          'air_gap' : 20, 'nfft' : 4096, 'save_figure' : False, 'n_threads' : n_threads}
+
+	output = find_surface_channel(lfp_data, ephys_params, params)
+
+	expected = surface_channel_per_channel(lfp_data, ephys_params, params, 3)
+
+	assert(output['surface_channel'] == expected)
+	assert(output['air_channel'] == np.min([expected + 20, num_channels]))
+	assert(abs(expected - 60) < 5)
+
+	# more (and shorter-spaced) windows than the AP band passes
+	params.update({'lfp_n_passes' : 11, 'skip_s_per_pass' : 1})
+
+	output = find_surface_channel(lfp_data, ephys_params, params)
+
+	assert(output['surface_channel'] == surface_channel_per_channel(lfp_data, ephys_params, params, 11))
@@ -0,0 +1,28 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.modules.kilosort_helper.noise_channels import get_noise_channels, get_noise_windows
+
+def test_noise_channels(tmp_path):
+
+	sample_rate = 2500.0
+	num_channels = 64
+
+	rng = np.random.RandomState(0)
+	data = (rng.randn(int(sample_rate * 45), num_channels) * 40).astype('int16')
+
+	# one channel is noisy throughout, another only during the first window
+	data[:, 20] = (rng.randn(data.shape[0]) * 400).astype('int16')
+	data[int(sample_rate * 5):int(sample_rate * 15), 40] = (rng.randn(int(sample_rate * 10)) * 400).astype('int16')
+
+	raw_data_file = str(tmp_path / 'continuous.dat')
+	data.tofile(raw_data_file)
+
+	assert(get_noise_windows(data.shape[0], sample_rate, 3, 5, 10) == \
+	       [(12500, 37500), (50000, 75000), (87500, 112500)])
+
+	mask = get_noise_channels(raw_data_file, num_channels, sample_rate, 0.195)
+	assert(list(np.where(~mask)[0]) == [20, 40])
+
+	mask = get_noise_channels(raw_data_file, num_channels, sample_rate, 0.195, num_windows=3, num_threads=2)
+	assert(list(np.where(~mask)[0]) == [20])
@@ -0,0 +1,65 @@
+import numpy as np
+import os
+
+from ecephys_spike_sorting.modules.kilosort_postprocessing.postprocessing import find_within_unit_overlap, \
+	find_between_unit_overlap, find_within_unit_overlaps, find_between_unit_overlaps, \
+	remove_spikes_from_npy
+
+def test_find_overlaps():
+
+	rng = np.random.RandomState(0)
+
+	num_units = 6
+
+	spike_times = np.sort(rng.choice(100000, 5000, replace = False))
+	spike_clusters = rng.randint(0, num_units, 5000)
+
+	to_remove = find_within_unit_overlaps(spike_times, spike_clusters, num_units, 30)
+
+	expected = np.concatenate([np.where(spike_clusters == unit)[0][find_within_unit_overlap(spike_times[spike_clusters == unit], 30)] for unit in range(num_units)])
+
+	assert(np.array_equal(to_remove, np.sort(expected)))
+
+	spike_times = np.delete(spike_times, to_remove)
+	spike_clusters = np.delete(spike_clusters, to_remove)
+
+	unit_rank = np.arange(num_units)
+	neighbors = np.ones((num_units, num_units), dtype = 'bool')
+	np.fill_diagonal(neighbors, False)
+	neighbors[0, 5] = neighbors[5, 0] = False
+
+	first_spikes, second_spikes = find_between_unit_overlaps(spike_times, spike_clusters, unit_rank, neighbors, 20)
+
+	for unit1 in range(num_units):
+		for unit2 in range(unit1 + 1, num_units):
+
+			for_unit1 = np.where(spike_clusters == unit1)[0]
+			for_unit2 = np.where(spike_clusters == unit2)[0]
+
+			# deleting from unit 1 removes both spikes of every overlapping pair that belong to it
+			to_remove1, to_remove2 = find_between_unit_overlap(spike_times[for_unit1], spike_times[for_unit2], 1, 2, 20)
+
+			in_pair = np.in1d(first_spikes, for_unit1) * np.in1d(second_spikes, for_unit2) + \
+					  np.in1d(first_spikes, for_unit2) * np.in1d(second_spikes, for_unit1)
+
+			expected = np.sort(for_unit1[to_remove1])
+			found = np.sort(np.where(np.in1d(first_spikes[in_pair], for_unit1), first_spikes[in_pair], second_spikes[in_pair]))
+
+			if neighbors[unit1, unit2]:
+				assert(np.array_equal(found, expected))
+			else:
+				assert(found.size == 0)
+
+def test_remove_spikes_from_npy(tmpdir):
+
+	pc_features = np.random.RandomState(0).randn(1000, 3, 8).astype('float32')
+
+	filename = os.path.join(str(tmpdir), 'pc_features.npy')
+	np.save(filename, pc_features)
+
+	spikes_to_remove = np.array([0, 5, 6, 7, 500, 999])
+
+	remove_spikes_from_npy(filename, spikes_to_remove, max_buffer_bytes = 1000)
+
+	assert(np.array_equal(np.load(filename), np.delete(pc_features, spikes_to_remove, 0)))
+	assert(not os.path.exists(filename + '.tmp'))
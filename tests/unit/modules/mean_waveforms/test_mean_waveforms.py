@@ -1,8 +1,15 @@
 import pytest
 import numpy as np
+import pandas as pd
 import os
+import multiprocessing
 
-from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import extract_waveforms
+from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import extract_waveforms, gather_waveforms, get_memmap_offset, WaveformAccumulator
+from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import init_waveform_worker, _waveform_worker_data
+from ecephys_spike_sorting.modules.mean_waveforms.waveform_metrics import calculate_snr, calculate_snr_from_stats, calculate_waveform_metrics
+from ecephys_spike_sorting.modules.mean_waveforms.waveform_metrics import calculate_waveform_metrics_from_stats
+import ecephys_spike_sorting.modules.mean_waveforms.waveform_metrics as waveform_metrics
+from ecephys_spike_sorting.common.epoch import Epoch
 import ecephys_spike_sorting.common.utils as utils
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
@@ -29,4 +36,326 @@ def test_extract_waveforms():
     
     data, spike_counts, coords, labels = extract_waveforms(data, spike_times, spike_clusters, cluster_ids, cluster_quality, bit_volts, sample_rate, params)
 
-    print(labels)
\ No newline at end of file
+    print(labels)
+
+def test_gather_waveforms():
+
+    data = np.random.RandomState(0).randint(-100, 100, (50000, 16)).astype('int16')
+
+    window_starts = np.array([40000, 10, 10, -5, 49950, 10050, 25000, 39990])
+
+    waveforms, is_valid = gather_waveforms(data, window_starts, 82, max_gap = 100)
+
+    assert(np.array_equal(is_valid, [True, True, True, False, False, True, True, True]))
+
+    for idx, start in enumerate(window_starts):
+        if is_valid[idx]:
+            assert(np.array_equal(waveforms[idx], data[start:start+82, :].T))
+        else:
+            assert(not np.any(waveforms[idx]))
+
+class RecordedReads():
+
+    """ Array wrapper that records the number of samples in each read """
+
+    def __init__(self, data):
+        self.data = data
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.read_sizes = []
+
+    def __getitem__(self, index):
+        block = self.data[index]
+        self.read_sizes.append(block.shape[0])
+        return block
+
+def test_gather_waveforms_block_size():
+
+    data = np.random.RandomState(0).randint(-100, 100, (50000, 16)).astype('int16')
+
+    # windows every 10 samples form a single run covering the whole file
+    window_starts = np.random.RandomState(1).permutation(np.arange(0, 49900, 10))
+    window_starts[:20] = window_starts[20]
+
+    raw_data = RecordedReads(data)
+
+    waveforms, is_valid = gather_waveforms(raw_data, window_starts, 82, max_block_samples = 1000)
+
+    assert(np.all(is_valid))
+    assert(len(raw_data.read_sizes) > 1)
+    assert(np.max(raw_data.read_sizes) <= 1000)
+
+    for idx, start in enumerate(window_starts):
+        assert(np.array_equal(waveforms[idx], data[start:start+82, :].T))
+
+    # the budget never stops a window from being read
+    raw_data = RecordedReads(data)
+
+    waveforms, is_valid = gather_waveforms(raw_data, window_starts[:50], 82, max_block_samples = 10)
+
+    assert(np.max(raw_data.read_sizes) == 82)
+    assert(np.array_equal(waveforms[0], data[window_starts[0]:window_starts[0]+82, :].T))
+
+def test_worker_memmap_of_rows(tmp_path):
+
+    num_channels = 16
+    raw_data_file = str(tmp_path / 'continuous.dat')
+
+    # 64-byte header, then int16 samples
+    with open(raw_data_file, 'wb') as f:
+        f.write(b'\x00' * 64)
+        f.write(np.random.RandomState(0).randint(-200, 200, (20000, num_channels)).astype('int16').tobytes())
+
+    raw_data = np.memmap(raw_data_file, dtype='int16', mode='r', offset=64, shape=(20000, num_channels))
+    rows = raw_data[5000:15000, :]
+
+    assert(get_memmap_offset(rows) == 64 + 5000 * num_channels * 2)
+    assert(get_memmap_offset(raw_data[:, :4]) is None)
+
+    # workers map the same rows as the parent
+    init_waveform_worker(raw_data_file, rows.dtype, get_memmap_offset(rows), rows.shape, {})
+
+    assert(np.array_equal(_waveform_worker_data['raw_data'], rows))
+
+    _waveform_worker_data.clear()
+
+
+def test_waveform_accumulator():
+
+    waveforms = np.random.RandomState(0).randn(1000, 8, 82) * 20 + 5
+
+    accumulator = WaveformAccumulator((8, 82))
+
+    for start in range(0, 1000, 300):
+        accumulator.add(waveforms[start:start+300])
+
+    accumulator.add(waveforms[:0])
+
+    assert(accumulator.count == 1000)
+    assert(np.allclose(accumulator.mean(), np.mean(waveforms, 0)))
+    assert(np.allclose(accumulator.std(), np.std(waveforms, 0)))
+
+    assert(np.isclose(calculate_snr_from_stats(accumulator.mean()[3], accumulator.std()[3]), calculate_snr(waveforms[:, 3, :])))
+
+    accumulator = WaveformAccumulator((8, 82), 'float32')
+    accumulator.add(waveforms)
+
+    assert(accumulator.mean().dtype == np.float32)
+    assert(np.allclose(accumulator.std(), np.std(waveforms, 0), rtol = 1e-4))
+
+    assert(np.all(np.isnan(WaveformAccumulator((8, 82)).mean())))
+
+
+@pytest.fixture
+def simple_2D_features(monkeypatch):
+
+    # calculate_2D_features needs site positions, which extract_waveforms does
+    # not have; use simple features of the 2D waveform instead
+    def features(waveform, timestamps, peak_channel, *args):
+        return np.ptp(waveform[peak_channel, :]), np.ptp(waveform), np.sum(waveform[:, 0]), np.sum(waveform[:, -1])
+
+    monkeypatch.setattr(waveform_metrics, 'calculate_2D_features', features)
+
+
+def make_synthetic_recording(num_samples = 40000, num_channels = 12, num_units = 5):
+
+    """ Noise plus spikes of a different shape for each unit (unit 3 has no spikes) """
+
+    rng = np.random.RandomState(0)
+
+    data = rng.randn(num_samples, num_channels) * 20
+
+    shapes = rng.randn(num_units, 82, num_channels) * 100
+
+    spike_times = []
+    spike_clusters = []
+
+    for unit in [0, 1, 2, 4]:
+        times = np.sort(rng.choice(np.arange(100, num_samples - 100), 50, replace = False))
+        for t in times:
+            data[t-20:t+62, :] += shapes[unit]
+        spike_times.append(times)
+        spike_clusters.append(np.ones(times.shape, dtype = 'int64') * unit)
+
+    # spikes too close to the start and end of the recording are left out
+    spike_times.append(np.array([5, num_samples - 10]))
+    spike_clusters.append(np.array([0, 1]))
+
+    order = np.argsort(np.concatenate(spike_times), kind = 'stable')
+
+    spike_times = np.concatenate(spike_times)[order]
+    spike_clusters = np.concatenate(spike_clusters)[order]
+
+    return data.astype('int16'), spike_times, spike_clusters, shapes
+
+
+def make_params(**params):
+
+    defaults = {'samples_per_spike' : 82,
+                'pre_samples' : 20,
+                'num_epochs' : 1,
+                'spikes_per_epoch' : 30,
+                'upsampling_factor' : 200 / 82,
+                'spread_threshold' : 0.12,
+                'site_range' : 16}
+
+    defaults.update(params)
+
+    return defaults
+
+
+def extract_waveforms_per_spike(raw_data, spike_times, spike_clusters, templates, channel_map, bit_volts, sample_rate, site_spacing, params, epochs):
+
+    """ Reference implementation: reads, stores and averages every spike of each unit in turn """
+
+    samples_per_spike = params['samples_per_spike']
+    pre_samples = params['pre_samples']
+    spikes_per_epoch = params['spikes_per_epoch']
+
+    cluster_ids = np.arange(np.max(spike_clusters) + 1)
+
+    mean_waveforms = np.zeros((len(cluster_ids), len(epochs), 2, raw_data.shape[1], samples_per_spike))
+    spike_count = np.zeros((len(cluster_ids), len(epochs) + 1), dtype = 'int')
+    metrics = []
+
+    peak_channels = np.squeeze(channel_map[np.argmax(np.max(templates,1) - np.min(templates,1),1)])
+
+    for epoch_idx, epoch in enumerate(epochs):
+
+        in_epoch = ((spike_times / sample_rate) > epoch.start_time) * ((spike_times / sample_rate) < epoch.end_time)
+
+        spike_times_in_epoch = spike_times[in_epoch]
+
+        for cluster_idx, cluster_id in enumerate(cluster_ids):
+
+            in_cluster = (spike_clusters[in_epoch] == cluster_id)
+
+            if np.sum(in_cluster) > 0:
+
+                times_for_cluster = spike_times_in_epoch[in_cluster]
+
+                waveforms = np.empty((spikes_per_epoch, raw_data.shape[1], samples_per_spike))
+                waveforms[:] = np.nan
+
+                np.random.shuffle(times_for_cluster)
+
+                total_waveforms = np.min([times_for_cluster.size, spikes_per_epoch])
+
+                for wv_idx, peak_time in enumerate(times_for_cluster[:total_waveforms]):
+                    start = int(peak_time-pre_samples)
+                    rawWaveform = raw_data[np.max([start, 0]):start + samples_per_spike, :].T
+                    if start >= 0 and rawWaveform.shape[1] == samples_per_spike:
+                        waveforms[wv_idx, :, :] = rawWaveform * bit_volts
+
+                metrics.append(calculate_waveform_metrics(waveforms[:total_waveforms], cluster_id, peak_channels[cluster_idx],
+                                                          channel_map, sample_rate, params['upsampling_factor'],
+                                                          params['spread_threshold'], params['site_range'], site_spacing, epoch.name))
+
+                mean_waveforms[cluster_idx, epoch_idx, 0] = np.nanmean(waveforms, 0)
+                mean_waveforms[cluster_idx, epoch_idx, 0] -= mean_waveforms[cluster_idx, epoch_idx, 0, :, :1]
+                mean_waveforms[cluster_idx, epoch_idx, 1] = np.nanstd(waveforms, 0)
+
+                spike_count[cluster_idx, epoch_idx] = total_waveforms
+
+    return mean_waveforms, spike_count, pd.concat(metrics)
+
+
+def test_extract_waveforms_synthetic(simple_2D_features):
+
+    data, spike_times, spike_clusters, templates = make_synthetic_recording()
+
+    channel_map = np.arange(data.shape[1])
+    epochs = [Epoch('first', 0, 0.6), Epoch('second', 0.6, np.inf)]
+    params = make_params()
+
+    np.random.seed(1)
+
+    expected_waveforms, expected_count, expected_metrics = extract_waveforms_per_spike(data, spike_times, spike_clusters, templates,
+                                                                                       channel_map, 0.195, 30000.0, 20e-6, params, epochs)
+
+    np.random.seed(1)
+
+    # a small buffer, so spikes are read in several chunks and blocks
+    mean_waveforms, spike_count, coords, labels, metrics = extract_waveforms(data, spike_times, spike_clusters, templates,
+                                                                             channel_map, 0.195, 30000.0, 20e-6, params,
+                                                                             epochs = epochs, max_buffer_bytes = 1e5)
+
+    assert(np.array_equal(spike_count, expected_count))
+    assert(np.allclose(mean_waveforms, expected_waveforms))
+
+    pd.testing.assert_frame_equal(metrics.reset_index(drop = True), expected_metrics.reset_index(drop = True))
+
+
+# workers only see the replaced calculate_2D_features if they are forked
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason = 'requires forked workers')
+def test_extract_waveforms_parallel(tmp_path, simple_2D_features, monkeypatch):
+
+    # use the worker pool even on a single CPU
+    monkeypatch.setattr(multiprocessing, 'cpu_count', lambda: 2)
+
+    data, spike_times, spike_clusters, templates = make_synthetic_recording()
+
+    raw_data_file = str(tmp_path / 'continuous.dat')
+
+    # 64-byte header, then int16 samples
+    with open(raw_data_file, 'wb') as f:
+        f.write(b'\x00' * 64)
+        f.write(data.tobytes())
+
+    raw_data = np.memmap(raw_data_file, dtype='int16', mode='r', offset=64, shape=data.shape)
+
+    # workers open the file at the offset of the first of these rows
+    rows = raw_data[1000:, :]
+    spike_times = spike_times - 1000
+
+    channel_map = np.arange(data.shape[1])
+    epochs = [Epoch('first', 0, 0.6), Epoch('second', 0.6, np.inf)]
+
+    results = []
+
+    for num_workers in [1, 2]:
+
+        np.random.seed(1)
+
+        results.append(extract_waveforms(rows, spike_times, spike_clusters, templates, channel_map, 0.195, 30000.0, 20e-6,
+                                         make_params(multiprocessing_worker_count = num_workers),
+                                         epochs = epochs, max_buffer_bytes = 1e5))
+
+    serial, parallel = results
+
+    # the pool uses smaller batches, so spikes are summed in a different order
+    assert(np.allclose(parallel[0], serial[0]))
+    assert(np.array_equal(parallel[1], serial[1]))
+
+    pd.testing.assert_frame_equal(parallel[4].reset_index(drop = True), serial[4].reset_index(drop = True))
+
+
+@pytest.mark.parametrize('dtype, rtol', [('float64', 1e-9), ('float32', 1e-4)])
+def test_waveform_metrics_from_stats(simple_2D_features, dtype, rtol):
+
+    rng = np.random.RandomState(0)
+
+    waveforms = rng.randn(12, 82) * 100 + rng.randn(60, 12, 82) * 20
+
+    # missing spikes (at the start or end of the recording) are NaN
+    waveforms[[7, 30]] = np.nan
+    is_valid = ~np.isnan(waveforms[:, 0, 0])
+
+    peak_channel = 5
+    args = (3, peak_channel, np.arange(12), 30000.0, 200 / 82, 0.12, 16, 20e-6, 'complete_session')
+
+    expected = calculate_waveform_metrics(waveforms, *args)
+
+    assert(np.isclose(expected['snr'][0], calculate_snr(waveforms[:, peak_channel, :])))
+
+    accumulator = WaveformAccumulator((12, 82), dtype)
+
+    for start in range(0, 60, 25):
+        accumulator.add(waveforms[start:start+25][is_valid[start:start+25]])
+
+    assert(np.isclose(calculate_snr_from_stats(accumulator.mean()[peak_channel], accumulator.std()[peak_channel]),
+                      calculate_snr(waveforms[:, peak_channel, :]), rtol = rtol))
+
+    metrics = calculate_waveform_metrics_from_stats(accumulator.mean(), accumulator.std(), *args)
+
+    pd.testing.assert_frame_equal(metrics, expected, check_dtype = False, rtol = rtol)
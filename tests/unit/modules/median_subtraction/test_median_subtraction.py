@@ -0,0 +1,79 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.modules.median_subtraction.median_subtraction import subtract_median, median_subtract_file
+
+def subtract_median_sample(sample, offset, scaling, mask, air_channel):
+
+	# one sample at a time, as in SpikeBandMedianSubtraction
+	sample = (sample[:air_channel] - offset[:air_channel].astype('int16')).astype('int16')
+
+	output = sample.copy()
+	residuals = np.zeros((24,), dtype='int16')
+
+	for group in range(24):
+		channels = np.arange(group, air_channel, 24)
+		values = np.sort(sample[channels[mask[channels] > 0]])
+		if values.size > 0:
+			residuals[group] = values[(values.size - 1) // 2]
+		for channel in channels:
+			output[channel] = sample[channel] - np.int16(np.int32(np.float32(residuals[group]) * np.float32(scaling[channel])))
+
+	return output, residuals
+
+def make_probe(num_channels=96):
+
+	rng = np.random.RandomState(0)
+
+	offset = rng.randint(-20, 20, num_channels)
+	scaling = rng.uniform(0.5, 1.5, num_channels)
+	mask = np.ones((num_channels,), dtype='int')
+	mask[[3, 27, 51, 75]] = 0   # every channel in group 3 is masked
+	mask[10] = 0
+
+	return offset, scaling, mask
+
+def test_subtract_median():
+
+	offset, scaling, mask = make_probe()
+	air_channel = 90
+
+	data = np.random.RandomState(1).randint(-500, 500, (50, 96)).astype('int16')
+
+	output, residuals = subtract_median(data, offset, scaling, mask, air_channel)
+
+	for i in range(data.shape[0]):
+		expected_output, expected_residuals = subtract_median_sample(data[i, :], offset, scaling, mask, air_channel)
+		assert(np.array_equal(output[i, :air_channel], expected_output))
+		assert(np.array_equal(residuals[i, :], expected_residuals))
+
+	assert(np.array_equal(output[:, air_channel:], data[:, air_channel:]))
+
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_median_subtract_file(tmp_path, num_workers):
+
+	offset, scaling, mask = make_probe()
+
+	data = np.random.RandomState(2).randint(-500, 500, (1000, 96)).astype('int16')
+
+	input_file = str(tmp_path / 'continuous.dat')
+	output_file = str(tmp_path / 'median_subtracted.dat')
+
+	with open(input_file, 'wb') as f:
+		f.write(data.tobytes() + b'\x01')
+
+	expected_output, expected_residuals = subtract_median(data, offset, scaling, mask, 90)
+
+	residuals_file = median_subtract_file(input_file, 96, offset, scaling, mask, 90,
+	                                      output_file=output_file, chunk_samples=300, num_workers=num_workers)
+
+	with open(output_file, 'rb') as f:
+		assert(f.read() == expected_output.tobytes() + b'\x01')
+
+	assert(np.array_equal(np.fromfile(residuals_file, dtype='int16').reshape(-1, 24), expected_residuals))
+
+	# in place, the input file is overwritten with the same data
+	median_subtract_file(input_file, 96, offset, scaling, mask, 90, chunk_samples=300, num_workers=num_workers)
+
+	with open(input_file, 'rb') as f:
+		assert(f.read() == expected_output.tobytes() + b'\x01')
@@ -2,7 +2,10 @@ import pytest
 import numpy as np
 import os
 
+from scipy.interpolate import griddata
+
 from ecephys_spike_sorting.modules.noise_templates.id_noise_templates import id_noise_templates_rf
+import ecephys_spike_sorting.modules.noise_templates.id_noise_templates as id_noise_templates
 import ecephys_spike_sorting.common.utils as utils
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
@@ -20,4 +23,21 @@ def test_noise_templates():
 	
 	cluster_ids, is_noise = id_noise_templates_rf(spike_times, spike_clusters, cluster_ids, templates, params)
 
-	assert(len(cluster_ids) == len(is_noise))
\ No newline at end of file
+	assert(len(cluster_ids) == len(is_noise))
+
+def test_interpolate_template():
+
+	channel_map = np.arange(96)
+	template = np.random.RandomState(0).randn(5, 96)
+
+	loc_a = id_noise_templates.actual_channel_locations(channel_map)
+	loc_i = id_noise_templates.interp_channel_locations(channel_map)
+
+	grid = id_noise_templates.get_interpolation_grid(channel_map)
+	template_interp = id_noise_templates.interpolate_template(template, channel_map, grid)
+
+	assert(template_interp.shape == (5, 96, 7))
+
+	for t in range(template.shape[0]):
+		expected = griddata(loc_a, template[t,:], loc_i, method='cubic', fill_value=0, rescale=False)
+		assert(np.array_equal(template_interp[t,:,:].flatten(), expected))
@@ -3,10 +3,14 @@ import numpy as np
 import os
 
 from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_metrics
+import ecephys_spike_sorting.modules.quality_metrics.metrics as qm
 import ecephys_spike_sorting.common.utils as utils
+from ecephys_spike_sorting.common.spike_groups import SpikeGroups
+from ecephys_spike_sorting.common.channel_neighbors import ChannelNeighbors
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
 
+
 def te_st_quality_metrics():
 
 	sample_rate = 30000.0
@@ -31,6 +35,368 @@ def te_st_quality_metrics():
 
 	print(metrics)
 
+
+def make_spike_train(total_units=8, duration=600.0, seed=0):
+
+	rng = np.random.RandomState(seed)
+
+	spike_times = []
+	spike_clusters = []
+	amplitudes = []
+
+	for unit in range(total_units):
+		if unit == 3:
+			continue # leave one empty unit
+		n = rng.randint(200, 2000)
+		spike_times.append(np.sort(rng.uniform(0, duration, n)))
+		spike_clusters.append(np.ones((n,), dtype='int') * unit)
+		amplitudes.append(rng.normal(20 + unit, 3, n))
+
+	order = np.argsort(np.concatenate(spike_times))
+
+	return np.concatenate(spike_times)[order], \
+	       np.concatenate(spike_clusters)[order], \
+	       np.concatenate(amplitudes)[order]
+
+
+def test_spike_groups():
+
+	spike_times, spike_clusters, amplitudes = make_spike_train()
+
+	groups = SpikeGroups(spike_clusters, 10)
+
+	assert(np.array_equal(groups.cluster_ids, np.unique(spike_clusters)))
+	assert(groups.count(3) == 0)
+	assert(groups.indices(12).size == 0)
+
+	sorted_times = groups.sort(spike_times)
+
+	for cluster_id in range(10):
+		for_cluster = spike_clusters == cluster_id
+		assert(np.array_equal(groups.indices(cluster_id), np.where(for_cluster)[0]))
+		assert(np.array_equal(groups.segment(sorted_times, cluster_id), spike_times[for_cluster]))
+
+	np.random.seed(1)
+	mask = qm.make_index_mask(spike_clusters, 2, min_num=0, max_num=50)
+	np.random.seed(1)
+	inds = groups.subsample(2, 50)
+
+	assert(np.array_equal(np.where(mask)[0], inds))
+
+
+def test_grouped_metrics_match_masks():
+
+	spike_times, spike_clusters, amplitudes = make_spike_train()
+	total_units = 8
+
+	isi_viol = qm.calculate_isi_violations(spike_times, spike_clusters, total_units, 0.0015, 0.0)
+	presence_ratio = qm.calculate_presence_ratio(spike_times, spike_clusters, total_units)
+	firing_rate = qm.calculate_firing_rate(spike_times, spike_clusters, total_units)
+	amplitude_cutoff = qm.calculate_amplitude_cutoff(spike_clusters, amplitudes, total_units)
+
+	min_time = np.min(spike_times)
+	max_time = np.max(spike_times)
+
+	for cluster_id in np.unique(spike_clusters):
+		for_cluster = spike_clusters == cluster_id
+		assert(isi_viol[cluster_id] == qm.isi_violations(spike_times[for_cluster], min_time, max_time, 0.0015, 0.0)[0])
+		assert(presence_ratio[cluster_id] == qm.presence_ratio(spike_times[for_cluster], min_time, max_time))
+		assert(firing_rate[cluster_id] == qm.firing_rate(spike_times[for_cluster], min_time, max_time))
+		assert(amplitude_cutoff[cluster_id] == qm.amplitude_cutoff(amplitudes[for_cluster]))
+
+
+def make_pc_features(total_units=20, num_channels=24, channels_per_unit=8, num_pcs=3, seed=0):
+
+	rng = np.random.RandomState(seed)
+
+	channel_pos = np.stack((np.tile([0, 16], num_channels // 2),
+	                        np.repeat(np.arange(num_channels // 2) * 20, 2)), 1).astype('float')
+
+	peak_channels = rng.randint(0, num_channels, total_units)
+	pc_feature_ind = np.zeros((total_units, channels_per_unit), dtype='uint32')
+
+	for unit in range(total_units):
+		dist = np.abs(channel_pos[:,1] - channel_pos[peak_channels[unit],1])
+		pc_feature_ind[unit,:] = np.argsort(dist, kind='stable')[:channels_per_unit]
+
+	spike_clusters = np.repeat(np.arange(total_units), rng.randint(100, 600, total_units))
+	spike_clusters = spike_clusters[rng.permutation(spike_clusters.size)]
+
+	centers = np.abs(rng.normal(0, 2, (total_units, num_pcs, num_channels)))
+	pc_features = np.zeros((spike_clusters.size, num_pcs, channels_per_unit), dtype='float32')
+
+	for unit in range(total_units):
+		for_unit = spike_clusters == unit
+		pc_features[for_unit] = centers[unit][:, pc_feature_ind[unit]] + \
+		                        rng.normal(0, 1, (np.sum(for_unit), num_pcs, channels_per_unit))
+
+	return spike_clusters, pc_features, pc_feature_ind, channel_pos
+
+
+def test_parallel_pc_metrics():
+
+	spike_clusters, pc_features, pc_feature_ind, channel_pos = make_pc_features()
+
+	results = []
+
+	for num_workers in [1, 2]:
+		np.random.seed(0)
+		results.append(np.array(qm.calculate_pc_metrics(spike_clusters, 20, pc_features, pc_feature_ind,
+		                                                channel_pos, 35, 200, 10000, 4,
+		                                                num_workers=num_workers)))
+
+	assert(np.sum(np.isfinite(results[0][0])) > 0)
+	assert(np.array_equal(results[0], results[1], equal_nan=True))
+
+
+def test_binned_medians():
+
+	spike_times, spike_clusters, amplitudes = make_spike_train()
+	total_units = 8
+
+	interval_starts = np.arange(np.min(spike_times), np.max(spike_times), 51)
+	interval_ends = interval_starts + 51
+
+	medians = qm.binned_medians(spike_times, spike_clusters, amplitudes, total_units,
+	                            interval_starts, interval_ends, 20)
+
+	for cluster_id in range(total_units):
+		for idx, (t1, t2) in enumerate(zip(interval_starts, interval_ends)):
+			in_range = (spike_clusters == cluster_id) * (spike_times > t1) * (spike_times < t2)
+			if np.sum(in_range) >= 20:
+				assert(medians[cluster_id, idx] == np.median(amplitudes[in_range]))
+			else:
+				assert(np.isnan(medians[cluster_id, idx]))
+
+
+def test_pairwise_silhouette_scores():
+
+	from sklearn.metrics import silhouette_score
+
+	spike_clusters, pc_features, pc_feature_ind, channel_pos = make_pc_features(total_units=8)
+
+	spike_inds = np.random.RandomState(0).permutation(spike_clusters.size)[:1000]
+
+	all_pcs = qm.make_sparse_pcs(spike_clusters, pc_features, pc_feature_ind, spike_inds)
+	cluster_labels = spike_clusters[spike_inds]
+
+	SS = qm.pairwise_silhouette_scores(all_pcs, cluster_labels, 8)
+
+	dense_pcs = all_pcs.toarray()
+
+	for i in range(8):
+		for j in range(i + 1, 8):
+			inds = np.in1d(cluster_labels, [i, j])
+			assert(np.isclose(SS[i,j], silhouette_score(dense_pcs[inds], cluster_labels[inds])))
+
+
+def test_channel_neighbors():
+
+	spike_clusters, pc_features, pc_feature_ind, channel_pos = make_pc_features()
+
+	channel_neighbors = ChannelNeighbors(channel_pos, pc_feature_ind)
+
+	for channel in range(channel_pos.shape[0]):
+
+		dist = np.sqrt(np.square(channel_pos[:,0] - channel_pos[channel,0]) + \
+		               np.square(channel_pos[:,1] - channel_pos[channel,1]))
+
+		assert(np.array_equal(channel_neighbors.distances_from(channel), dist))
+		assert(np.array_equal(channel_neighbors.within_radius(channel, 35), np.where(dist < 35)[0]))
+
+		units, channel_index = channel_neighbors.units_with_pcs_on(channel)
+		expected_units, expected_index = np.unravel_index(np.where(pc_feature_ind.flatten() == channel)[0], pc_feature_ind.shape)
+
+		assert(np.array_equal(units, expected_units))
+		assert(np.array_equal(channel_index, expected_index))
+
+	neighbors = channel_neighbors.neighbor_table(np.array([0, 1, 10]), 25)
+
+	assert(np.array_equal(neighbors, [[True, True, False], [True, True, False], [False, False, True]]))
+
+
+def test_stack_unit_pcs():
+
+	spike_clusters, pc_features, pc_feature_ind, channel_pos = make_pc_features()
+
+	unit_spikes = [np.where(spike_clusters == unit)[0][:50] for unit in (2, 5, 7)]
+	channel_masks = [np.array([0, 1, 2]), np.array([3, 4, 5]), np.array([1, 2, 3])]
+
+	all_pcs, all_labels = qm.stack_unit_pcs(pc_features, unit_spikes, channel_masks, [2, 5, 7], 3)
+
+	expected = np.concatenate([qm.get_unit_pcs(pc_features, spikes, mask) for spikes, mask in zip(unit_spikes, channel_masks)])
+
+	assert(all_pcs.dtype == np.float32)
+	assert(np.array_equal(all_pcs, expected))
+	assert(np.array_equal(all_labels, np.repeat([2, 5, 7], 50)))
+
+
+def test_random_projection_nn_metrics():
+
+	rng = np.random.RandomState(0)
+
+	centers = rng.normal(0, 0.4, (4, 24)) # overlapping units
+	all_labels = rng.randint(0, 4, 5000)
+	all_pcs = centers[all_labels] + rng.normal(0, 1, (5000, 24))
+
+	indices = qm.random_projection_kneighbors(all_pcs, 4, random_state = np.random.RandomState(1))
+
+	assert(np.array_equal(indices[:,0], np.arange(5000)))
+
+	for unit in range(4):
+
+		exact = qm.nearest_neighbors_metrics(all_pcs, all_labels, unit, 10000, 4)
+		approximate = qm.nearest_neighbors_metrics(all_pcs, all_labels, unit, 10000, 4,
+		                                           'random_projection', np.random.RandomState(1))
+
+		assert(np.allclose(exact, approximate, atol = 0.01))
+
+	with pytest.raises(ValueError):
+		qm.nearest_neighbors_metrics(all_pcs, all_labels, 0, 10000, 4, 'hnsw')
+
+
+def test_squared_mahalanobis_distances():
+
+	from scipy.spatial.distance import cdist
+
+	rng = np.random.RandomState(0)
+
+	pcs = rng.normal(0, 1, (2000, 12)) @ rng.normal(0, 1, (12, 12))
+	others = rng.normal(1, 2, (5000, 12))
+
+	mean_value = np.mean(pcs, 0)
+	covariance = np.cov(pcs.T)
+
+	expected = cdist(mean_value[np.newaxis, :], others, 'mahalanobis', VI = np.linalg.inv(covariance))[0] ** 2
+
+	distances = qm.squared_mahalanobis_distances(others, mean_value, np.linalg.cholesky(covariance), batch_size = 1000)
+	assert(np.allclose(distances, expected))
+
+	distances = qm.squared_mahalanobis_distances(others.astype('float32'), mean_value, np.linalg.cholesky(covariance))
+	assert(np.allclose(distances, expected, rtol = 1e-4))
+
+
+def test_incremental_pc_metrics(tmp_path):
+
+	from ecephys_spike_sorting.modules.quality_metrics.metrics_cache import MetricsCache
+
+	spike_clusters, pc_features, pc_feature_ind, channel_pos = make_pc_features()
+
+	cache_file = str(tmp_path / 'metrics_cache.csv')
+
+	def run(spike_clusters, metrics_cache):
+		np.random.seed(0)
+		return np.array(qm.calculate_pc_metrics(spike_clusters, 20, pc_features, pc_feature_ind,
+		                                        channel_pos, 35, 200, 10000, 4,
+		                                        metrics_cache=metrics_cache))
+
+	metrics_cache = MetricsCache(cache_file)
+	first = run(spike_clusters, metrics_cache)
+	metrics_cache.save()
+
+	assert(np.array_equal(first, run(spike_clusters, None), equal_nan=True))
+
+	# merge two units; the result should match a full recomputation
+	merged = spike_clusters.copy()
+	merged[merged == 1] = 0
+
+	metrics_cache = MetricsCache(cache_file)
+	assert(np.array_equal(run(merged, metrics_cache), run(merged, None), equal_nan=True))
+
+	metrics_cache.save()
+	assert(np.array_equal(run(merged, MetricsCache(cache_file)), run(merged, None), equal_nan=True))
+
+
+def test_epoch_views(tmp_path):
+
+	from ecephys_spike_sorting.common.epoch import Epoch
+
+	spike_times, spike_clusters, amplitudes = make_spike_train()
+
+	for epoch in [Epoch('a', 0, 100.5), Epoch('b', spike_times[10], spike_times[500]), Epoch('c', 0, np.inf)]:
+		in_epoch = (spike_times > epoch.start_time) * (spike_times < epoch.end_time)
+		assert(np.array_equal(spike_times[epoch.spike_slice(spike_times)], spike_times[in_epoch]))
+
+	# workers reopen the source file for a memory-mapped range of rows
+	filename = str(tmp_path / 'pc_features.npy')
+	np.save(filename, np.random.rand(100, 3, 8).astype('float32'))
+	pc_features = np.load(filename, mmap_mode='r')
+
+	npy_file, rows = qm.get_npy_file(pc_features[20:45], str(tmp_path))
+
+	assert(npy_file == filename)
+	assert(np.array_equal(np.load(npy_file, mmap_mode='r')[rows], pc_features[20:45]))
+
+
+def test_isi_violations_with_duplicates():
+
+	spike_times, spike_clusters, amplitudes = make_spike_train()
+
+	# add duplicate spikes and short ISIs, some at the boundaries between units
+	rng = np.random.RandomState(1)
+	extra = rng.choice(spike_times.size, 300, replace=False)
+	spike_times = np.concatenate((spike_times, spike_times[extra] + rng.choice([0, 0.0001, 0.001], 300)))
+	spike_clusters = np.concatenate((spike_clusters, spike_clusters[extra]))
+	order = np.argsort(spike_times, kind='stable')
+	spike_times, spike_clusters = spike_times[order], spike_clusters[order]
+
+	isi_viol = qm.calculate_isi_violations(spike_times, spike_clusters, 8, 0.0015, 0.0002)
+
+	min_time = np.min(spike_times)
+	max_time = np.max(spike_times)
+
+	for cluster_id in np.unique(spike_clusters):
+		for_cluster = spike_clusters == cluster_id
+		assert(isi_viol[cluster_id] == qm.isi_violations(spike_times[for_cluster], min_time, max_time, 0.0015, 0.0002)[0])
+
+	assert(np.sum(isi_viol > 0) > 0)
+
+
+def test_amplitude_cutoff_on_bin_edges():
+
+	rng = np.random.RandomState(0)
+
+	# integer amplitudes fall exactly on bin edges; unit 2 has a single value
+	spike_clusters = rng.randint(0, 4, 20000)
+	amplitudes = rng.randint(0, 50, 20000).astype('float') / 4
+	amplitudes[spike_clusters == 2] = 7.0
+
+	amplitude_cutoff = qm.calculate_amplitude_cutoff(spike_clusters, amplitudes[:, np.newaxis], 5)
+
+	for cluster_id in range(4):
+		assert(amplitude_cutoff[cluster_id] == qm.amplitude_cutoff(amplitudes[spike_clusters == cluster_id]))
+
+
+def test_mahalanobis_metrics_nearly_singular():
+
+	from scipy.spatial.distance import cdist
+	from scipy.stats import chi2
+
+	# the last PC is almost a linear combination of the others, so the
+	# covariance is not positive definite to rounding error, but can still
+	# be inverted
+	rng = np.random.RandomState(6)
+	pcs = rng.randn(200, 3)
+	pcs_for_this_unit = np.column_stack((pcs, pcs[:,0] * 3 - pcs[:,1] * 0.7 + pcs[:,2] + rng.randn(200) * 1e-7))
+	pcs_for_other_units = rng.randn(300, 4) * 2 + 1
+
+	all_pcs = np.concatenate((pcs_for_this_unit, pcs_for_other_units))
+	all_labels = np.concatenate((np.zeros((200,), dtype='int'), np.ones((300,), dtype='int')))
+
+	with pytest.raises(np.linalg.LinAlgError):
+		np.linalg.cholesky(np.cov(pcs_for_this_unit.T))
+
+	isolation_distance, l_ratio = qm.mahalanobis_metrics(all_pcs, all_labels, 0)
+
+	# same calculation as before the Cholesky factorization was used
+	VI = np.linalg.inv(np.cov(pcs_for_this_unit.T))
+	mahalanobis_other = np.sort(cdist(np.expand_dims(np.mean(pcs_for_this_unit,0),0),
+	                                  pcs_for_other_units, 'mahalanobis', VI = VI)[0])
+
+	assert(np.isfinite(isolation_distance))
+	assert(np.isclose(isolation_distance, pow(mahalanobis_other[199],2)))
+	assert(np.isclose(l_ratio, np.sum(1 - chi2.cdf(pow(mahalanobis_other,2), 4)) / 300))
+
 if __name__ == "__main__":
     #test_quality_metrics()
-    pass
\ No newline at end of file
+    pass